@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+One app for the services: the chosen ones are imported only when the app is created and mounted as blueprints,
+configured from a file and the environment. In the WSGI file or for the WSGI server directly:
+
+    from application import create_app
+    app = create_app()
+
+    gunicorn --workers 2 'application:create_app()'
+
+The event streams (/scan/events, /print/events) and the long polls of the states hold a sync worker for as long
+as they are open, serve them with serve.py or with Gunicorn's gevent workers instead:
+
+    gunicorn --worker-class gevent --workers 1 --worker-connections 1000 'application:create_app()'
+
+Settings are named after the module of the constant they replace: PRINTREST_PRINTER, SCANREST_SCANNERS,
+POSTPROCESS_WORKERS, APPLICATION_WARM_UP... The config file is Python (like the constants in the modules),
+the environment variables are JSON or plain strings and win over the file. Other settings of the file go to Flask
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import importlib
+import threading
+
+from flask import Flask
+
+import metrics
+
+SERVICES = ('scanrest', 'printrest', 'copyrest')  # Mounted when create_app() is not given the services
+CONFIG_ENV = 'DRIVERLESS_CONFIG'  # Environment variable with the path of the config file
+# Modules with constants which can be set in the config file or in the environment
+CONFIGURABLE = ('application', 'scanrest', 'printrest', 'copyrest', 'postprocess', 'pages', 'poller', 'metrics', 'ipp')
+# Query the devices (capabilities, printer states, pooled connections) and render the forms in the background
+# when the app is created, e.g. when a Gunicorn worker starts (do not use it with --preload, the connections are
+# opened per process)
+WARM_UP = False
+
+logger = logging.getLogger('application')
+
+# module name -> the app of the service alone (from printrest import app)
+_service_apps = {}
+_service_apps_lock = threading.Lock()
+
+
+def load_config(config, path=None):
+    """
+    The settings of the config file (path or $DRIVERLESS_CONFIG) and of the environment variables which start with
+    the name of a configurable module (their values are kept as strings until they are applied)
+    """
+    path = path or os.environ.get(CONFIG_ENV)
+    if path:
+        config.from_pyfile(path)
+    prefixes = tuple('{0}_'.format(name.upper()) for name in CONFIGURABLE)
+    config.update((name, value) for name, value in os.environ.items() if name.startswith(prefixes))
+    return config
+
+
+def configure(module, config):
+    """
+    Replace the constants of the module with the settings named <MODULE>_<CONSTANT>. Strings (from the environment)
+    are parsed as JSON for constants which are not strings, lists become tuples or sets like the constant
+    """
+    prefix = '{0}_'.format(module.__name__.upper())
+    for key, value in config.items():
+        if not key.startswith(prefix) or key in Flask.default_config:  # e.g. APPLICATION_ROOT is for Flask
+            continue
+        name = key[len(prefix):]
+        if not name.isupper() or not hasattr(module, name):
+            logger.warning('Unknown setting: %s (%s has no %s)', key, module.__name__, name)
+            continue
+        current = getattr(module, name)
+        if isinstance(value, str) and not isinstance(current, str):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        if isinstance(current, (tuple, set, frozenset)) and isinstance(value, list):
+            value = type(current)(value)
+        setattr(module, name, value)
+
+
+def create_app(services=None, config_file=None, warm_up=None):
+    app = Flask(__name__)
+    load_config(app.config, config_file)
+    configure(sys.modules[__name__], app.config)
+
+    modules = [importlib.import_module(name) for name in services or SERVICES]
+    for name in CONFIGURABLE:
+        if name in sys.modules:  # Modules which were not needed by the services are not imported for the settings
+            configure(sys.modules[name], app.config)
+
+    metrics.init_app(app)
+    for module in modules:
+        module.init_app(app)
+
+    if WARM_UP if warm_up is None else warm_up:
+        threading.Thread(target=warm_up_services, args=(modules,), name='warm-up', daemon=True).start()
+    return app
+
+
+def service_app(name):
+    # The app of a single service, created once (the services create it for `from printrest import app`)
+    with _service_apps_lock:
+        if name not in _service_apps:
+            _service_apps[name] = create_app([name])
+        return _service_apps[name]
+
+
+def lazy_app(module_name):
+    """
+    The module __getattr__ of a service: `from printrest import app` (the WSGI file of that service alone)
+    creates the app of the service on first use
+    """
+    def __getattr__(name):
+        if name == 'app':
+            return service_app(module_name)
+        raise AttributeError('module {0!r} has no attribute {1!r}'.format(module_name, name))
+    return __getattr__
+
+
+def warm_up_services(modules):
+    start = time.perf_counter()
+    for module in modules:
+        try:
+            errors = module.warm_up()
+        except Exception as e:  # The workers serve the requests without warming up as well
+            errors = {module.__name__: str(e)}
+        for device, error in errors.items():
+            if error is not None:
+                logger.warning('Warming up %s failed: %s', device, error)
+    logger.info('Warmed up %s in %.2f seconds', ', '.join(module.__name__ for module in modules),
+                time.perf_counter() - start)
@@ -0,0 +1,287 @@
+#!/usr/bin/python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Load test printrest and scanrest against local stand-in devices, no printer or scanner is needed:
+
+    python3 benchmark.py --concurrency 8 --requests 200 --printer-latency 0.05 --scanner-latency 0.1
+
+A fake eSCL scanner (ScannerStatus, ScannerCapabilities, ScanJobs, NextDocument) and a fake IPP printer
+(Create-Job, Send-Document, Get-Printer-Attributes, ...) are started on localhost, both apps are served
+by threaded werkzeug servers and driven by concurrent clients. Throughput, p50/p99 latency and the peak RSS
+of the process (apps, devices and clients together) are reported for every scenario.
+"""
+
+import sys
+import time
+import argparse
+import resource
+import threading
+import itertools
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+
+from requests import Session
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from ipp import IPPPrinter
+
+ESCL_NAMESPACES = 'xmlns:pwg="http://www.pwg.org/schemas/2010/12/sm" ' \
+                  'xmlns:scan="http://schemas.hp.com/imaging/escl/2011/05/03"'
+
+INPUT_CAPS = """
+<scan:{0}>
+  <scan:MinWidth>16</scan:MinWidth><scan:MaxWidth>2550</scan:MaxWidth>
+  <scan:MinHeight>16</scan:MinHeight><scan:MaxHeight>3508</scan:MaxHeight>
+  <scan:MaxOpticalXResolution>600</scan:MaxOpticalXResolution>
+  <scan:MaxOpticalYResolution>600</scan:MaxOpticalYResolution>
+  <scan:SettingProfiles><scan:SettingProfile>
+    <scan:ColorModes>
+      <scan:ColorMode>BlackAndWhite1</scan:ColorMode><scan:ColorMode>Grayscale8</scan:ColorMode>
+      <scan:ColorMode>RGB24</scan:ColorMode>
+    </scan:ColorModes>
+    <scan:DocumentFormats>
+      <pwg:DocumentFormat>application/pdf</pwg:DocumentFormat><pwg:DocumentFormat>image/jpeg</pwg:DocumentFormat>
+    </scan:DocumentFormats>
+    <scan:SupportedResolutions><scan:DiscreteResolutions>
+      <scan:DiscreteResolution><scan:XResolution>300</scan:XResolution><scan:YResolution>300</scan:YResolution>
+      </scan:DiscreteResolution>
+      <scan:DiscreteResolution><scan:XResolution>600</scan:XResolution><scan:YResolution>600</scan:YResolution>
+      </scan:DiscreteResolution>
+    </scan:DiscreteResolutions></scan:SupportedResolutions>
+  </scan:SettingProfile></scan:SettingProfiles>
+  <scan:SupportedIntents><scan:Intent>Document</scan:Intent><scan:Intent>Photo</scan:Intent></scan:SupportedIntents>
+</scan:{0}>"""
+
+SCANNER_CAPABILITIES = """<?xml version="1.0" encoding="UTF-8"?>
+<scan:ScannerCapabilities {0}>
+  <pwg:Version>2.63</pwg:Version>
+  <pwg:MakeAndModel>Benchmark Scanner</pwg:MakeAndModel>
+  <pwg:SerialNumber>BENCH0001</pwg:SerialNumber>
+  <scan:Platen>{1}</scan:Platen>
+  <scan:Adf>{2}</scan:Adf>
+</scan:ScannerCapabilities>""".format(ESCL_NAMESPACES, INPUT_CAPS.format('PlatenInputCaps'),
+                                      INPUT_CAPS.format('AdfSimplexInputCaps'))
+
+SCANNER_STATUS = """<?xml version="1.0" encoding="UTF-8"?>
+<scan:ScannerStatus {0}>
+  <pwg:Version>2.63</pwg:Version>
+  <pwg:State>Idle</pwg:State>
+</scan:ScannerStatus>""".format(ESCL_NAMESPACES)
+
+
+class FakeDevice(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # The headers and the body are separate writes, with Nagle's algorithm the body would wait for the delayed
+    # ACK of the headers (~40 ms) on every keep-alive request
+    disable_nagle_algorithm = True
+    latency = 0.0  # Seconds added to every response
+
+    def log_message(self, *args):
+        pass
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b''.join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _reply(self, code, body=b'', content_type='text/xml', headers=()):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeScanner(FakeDevice):
+    """
+    eSCL scanner: documents are document_size bytes long (zeros, or document when it is set), the feeder holds
+    feeder_pages pages
+    """
+    document_size = 1024 * 1024
+    document = None
+    feeder_pages = 3
+    jobs = {}
+    job_ids = itertools.count(1)
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        if self.path == '/eSCL/ScannerStatus':
+            self._reply(200, SCANNER_STATUS.encode('UTF-8'))
+        elif self.path == '/eSCL/ScannerCapabilities':
+            self._reply(200, SCANNER_CAPABILITIES.encode('UTF-8'))
+        elif self.path.startswith('/eSCL/ScanJobs/') and self.path.endswith('/NextDocument'):
+            job_id = self.path.split('/')[3]
+            job = self.jobs.get(job_id)
+            if job is None or job['pages'] == 0:
+                self.jobs.pop(job_id, None)
+                self._reply(404)
+                return
+            job['pages'] -= 1
+            self.send_response(200)
+            self.send_header('Content-Type', job['format'])
+            self.send_header('Content-Location', '/eSCL/ScanJobs/{0}/{1}'.format(job_id, job['pages']))
+            if self.document is not None:
+                self.send_header('Content-Length', str(len(self.document)))
+                self.end_headers()
+                self.wfile.write(self.document)
+                return
+            self.send_header('Content-Length', str(self.document_size))
+            self.end_headers()
+            chunk = b'\0' * 65536
+            for start in range(0, self.document_size, len(chunk)):
+                self.wfile.write(chunk[:self.document_size - start])
+        else:
+            self._reply(404)
+
+    def do_POST(self):
+        body = self._read_body()
+        time.sleep(self.latency)
+        if self.path != '/eSCL/ScanJobs':
+            self._reply(404)
+            return
+        job_id = str(next(self.job_ids))
+        self.jobs[job_id] = {'pages': self.feeder_pages if b'Feeder' in body else 1,
+                             'format': 'application/pdf' if b'application/pdf' in body else 'image/jpeg'}
+        self._reply(201, headers=[('Location', 'http://{0}/eSCL/ScanJobs/{1}'.format(self.headers['Host'], job_id))])
+
+    def do_DELETE(self):
+        self.jobs.pop(self.path.split('/')[3], None)
+        self._reply(200)
+
+
+class FakePrinter(FakeDevice):
+    """
+    IPP printer: accepts every job and throws the documents away
+    """
+    job_ids = itertools.count(1)
+
+    def do_POST(self):
+        body = self._read_body()
+        time.sleep(self.latency)
+        _, operation, request_id, groups, _ = IPPPrinter.decode(body)
+        attributes = [('operation', [('charset', 'attributes-charset', 'utf-8'),
+                                     ('naturalLanguage', 'attributes-natural-language', 'en')])]
+        if operation == IPPPrinter.operations['Create-Job']:
+            attributes.append(('job', [('integer', 'job-id', next(self.job_ids)), ('enum', 'job-state', 3)]))
+        elif operation == IPPPrinter.operations['Get-Printer-Attributes']:
+            attributes.append(('printer', [('enum', 'printer-state', 3), ('keyword', 'printer-state-reasons', 'none'),
+                                           ('integer', 'queued-job-count', 0)]))
+        elif operation == IPPPrinter.operations['Get-Job-Attributes']:
+            attributes.append(('job', [('enum', 'job-state', 9)]))
+        self._reply(200, IPPPrinter.encode(0x0000, request_id, attributes), 'application/ipp')
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    disable_nagle_algorithm = True
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return '127.0.0.1:{0}'.format(server.server_port)
+
+
+def start_device(handler, latency):
+    handler = type(handler.__name__, (handler,), {'latency': latency})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    return serve(server)
+
+
+def start_app(app):
+    return serve(make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run_scenario(name, request_fun, requests, concurrency):
+    sessions = threading.local()
+
+    def timed_request(_):
+        if not hasattr(sessions, 'session'):
+            sessions.session = Session()
+        start = time.perf_counter()
+        ok = request_fun(sessions.session)
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(timed_request, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for latency, _ in results]
+    errors = sum(1 for _, ok in results if not ok)
+    peak_rss_mib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kilobytes on Linux
+    print('{0:<8} {1:>6} req {2:>4} err {3:>9.1f} req/s  p50 {4:>8.1f} ms  p99 {5:>8.1f} ms  peak RSS {6:>7.1f} MiB'.
+          format(name, requests, errors, requests / elapsed, percentile(latencies, 50) * 1000,
+                 percentile(latencies, 99) * 1000, peak_rss_mib))
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default='print,page,scan', help='Comma separated list of: print,page,scan')
+    parser.add_argument('--requests', type=int, default=100, help='Requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=4, help='Concurrent clients')
+    parser.add_argument('--upload-size', type=int, default=1024 * 1024, help='Bytes of the printed PDF')
+    parser.add_argument('--document-size', type=int, default=1024 * 1024, help='Bytes of a scanned page')
+    parser.add_argument('--printer-latency', type=float, default=0.0, help='Seconds added to each IPP response')
+    parser.add_argument('--scanner-latency', type=float, default=0.0, help='Seconds added to each eSCL response')
+    args = parser.parse_args()
+
+    import printrest
+    import scanrest
+
+    FakeScanner.document_size = args.document_size
+    printrest.BACKEND = 'ipp'
+    printrest.PRINTER = start_device(FakePrinter, args.printer_latency)
+    scanrest.SCANNER_IP = start_device(FakeScanner, args.scanner_latency)
+    scanrest.SCAN_QUEUE_LENGTH = args.concurrency
+    scanrest.SCAN_QUEUE_TIMEOUT = 3600
+    print_url = 'http://{0}/print'.format(start_app(printrest.app))
+    scan_url = 'http://{0}/scan'.format(start_app(scanrest.app))
+
+    # Every upload is a different document (numbered in a PDF comment), otherwise printrest would print it once
+    # and answer the others from DEDUP_WINDOW
+    uploads = itertools.count(1)
+    padding = b'\0' * max(0, args.upload_size - 20)
+    scan_form = {'inputSource': 'Platen', 'height': '', 'width': '', 'colormodes': 'Color', 'resolutions': '300',
+                 'formats': 'PDF', 'intents': 'Document'}
+
+    def print_upload(session):
+        pdf = '%PDF-1.4\n%{0:09d}\n'.format(next(uploads)).encode() + padding
+        resp = session.post(print_url, files={'uploadedPDF': ('benchmark.pdf', pdf, 'application/pdf')},
+                            data={'duplex': 'long', 'range': '', 'orientation': 'portrait', 'copies': ''})
+        return resp.status_code in {200, 202}
+
+    def capabilities_page(session):
+        return session.get(scan_url).status_code == 200
+
+    def scan(session):
+        resp = session.post(scan_url, data=scan_form, stream=True)
+        size = sum(len(chunk) for chunk in resp.iter_content(65536))
+        return resp.status_code == 200 and size == args.document_size
+
+    scenarios = {'print': print_upload, 'page': capabilities_page, 'scan': scan}
+    for name in args.scenarios.split(','):
+        run_scenario(name, scenarios[name], args.requests, args.concurrency)
+
+
+if __name__ == '__main__':
+    main()
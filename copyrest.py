@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+import time
+import tempfile
+from contextlib import ExitStack
+
+from flask import Blueprint, request
+from flask_restful import Resource
+from requests import RequestException
+from urllib3.exceptions import HTTPError
+
+import metrics
+import application
+from pages import PageCache, page_response
+import printrest
+from scanrest import ESCLScanner, ScanAborted, admit, get_scanner, get_scanners
+from printrest import choose_printer, release_printer, print_files, get_printers, admission_problem, rejection, \
+    parse_print_options, printer_candidates
+
+# Scan settings of a copy, the form fields of the same name override them
+COPY_DEFAULTS = {'inputSource': 'Platen', 'colormodes': 'Grayscale', 'resolutions': '300', 'intents': 'Document'}
+
+blueprint = Blueprint('copyrest', __name__)
+metrics.account_requests(blueprint, 'copyrest')
+pages = PageCache()
+
+copy_form = """
+<!DOCTYPE html>
+<html>
+<head>
+<style>
+body, html {
+
+    width: 100%;
+    height: 100%;
+    margin: 0;
+    padding: 0;
+    display:table;
+}
+body {
+    display:table-cell;
+    vertical-align:middle;
+}
+form {
+    display:table;/* shrinks to fit conntent */
+    margin:auto;
+}
+</style>
+</head>
+<body>
+
+<form action="" method="post">
+    <p>
+        Scanner: <br/>
+        <select name="scanner">
+SCANNER_OPTIONS_PLACEHOLDER
+        </select>
+    </p>
+    <p>
+        Input Source: <br/>
+        <select name="inputSource">
+            <option value="Platen">Platen</option>
+            <option value="Feeder">Feeder</option>
+        </select>
+    </p>
+    <p>
+        Color Mode: <br/>
+        <label><input type="radio" name="colormodes" value="Grayscale" checked> Grayscale</label>
+        <label><input type="radio" name="colormodes" value="Color"> Color</label>
+    </p>
+    <p>
+        Printer: <br/>
+        <select name="printer">
+PRINTER_OPTIONS_PLACEHOLDER
+        </select>
+    </p>
+    <p>
+        Duplex: <br/>
+        <label><input type="radio" name="duplex" value="none" checked> None</label>
+        <label><input type="radio" name="duplex" value="long"> Long edge</label>
+        <label><input type="radio" name="duplex" value="short"> Short edge</label>
+    </p>
+    <p>
+        Copies: <br/>
+        <input type="number" name="copies" min="1" placeholder="1">
+    </p>
+    <p>
+        <input type="submit" value="Copy" name="submit">
+    </p>
+</form>
+
+</body>
+</html>
+"""
+
+
+class CopyREST(Resource):
+    @staticmethod
+    @blueprint.route('/copy')
+    def usage():
+        return page_response(pages.get('copy', None, CopyREST._render_form))
+
+    @staticmethod
+    def _render_form():
+        scanner_options = '\n'.join('<option value="{0}">{0}</option>'.format(name) for name in get_scanners().keys())
+        printer_options = ['<option value="">Any</option>']
+        printer_options.extend('<option value="{0}">{0}</option>'.format(name) for name in
+                               list(printrest.PRINTER_CLASSES.keys()) + list(get_printers().keys()))
+        return copy_form.replace('SCANNER_OPTIONS_PLACEHOLDER', scanner_options).\
+            replace('PRINTER_OPTIONS_PLACEHOLDER', '\n'.join(printer_options))
+
+    @staticmethod
+    @blueprint.route('/copy', methods=['POST'])
+    def copy():
+        """
+        Scan to PDF and print the scanned documents as one job, they are kept on the server and never reach
+        the client. The scanner is released as soon as the last document is on disk, before printing
+        """
+        settings = {name: request.form.get(name) or default for name, default in COPY_DEFAULTS.items()}
+        try:
+            resolution = int(settings['resolutions'])
+        except ValueError:
+            return 'Values of {0} must be Integer instead of {1}!'.format('Resolution', settings['resolutions']), 400
+        options = parse_print_options({'duplex': request.form.get('duplex') or 'none', 'range': '',
+                                       'orientation': request.form.get('orientation') or 'portrait',
+                                       'copies': request.form.get('copies', '')})
+        if options is None:
+            return 'Some parameters wrong: {0} {1} {2}'.format(request.form.get('duplex'),
+                                                               request.form.get('orientation'),
+                                                               request.form.get('copies')), 400
+        duplex, _, orientation, copies = options
+
+        scanner = get_scanner(request.form.get('scanner', ''))
+        if scanner is None:
+            return 'No such scanner: {0}'.format(request.form['scanner']), 404
+
+        # A copy is not scanned if no printer it may go to can take it (stopped, out of paper...)
+        candidates = printer_candidates(request.form.get('printer', ''))
+        if candidates is None:
+            return 'No such printer or printer class: {0}'.format(request.form['printer']), 400
+        problems = {printer['name']: admission_problem(printer) for printer in candidates}
+        if all(problem is not None for problem in problems.values()):
+            metrics.inc('copyrest_rejected_total')
+            return rejection(problems)
+
+        printer = choose_printer(request.form.get('printer', ''))
+        with ExitStack() as stack:
+            try:
+                busy = admit(scanner, 'copyrest_phase_seconds')
+                if busy is not None:
+                    return busy
+                started = time.monotonic()
+                scanner['cancel'].clear()
+                try:
+                    documents = CopyREST._scan(stack, scanner, settings['inputSource'], settings['colormodes'],
+                                               resolution, settings['intents'])
+                finally:
+                    scanner['queue'].release(time.monotonic() - started)
+                    scanner['poller'].poke()
+
+                if isinstance(documents, tuple):  # The error of the scan
+                    ret = documents
+                else:
+                    with metrics.timed('copyrest_phase_seconds', 'print'):
+                        _, ret = print_files(printer, duplex, '', orientation, copies, documents)
+                    if ret is None:
+                        ret = 'Copied {0} document(s) from "{1}" to "{2}" with duplex "{3}" {4} times...'.format(
+                            len(documents), scanner['name'], printer['name'], duplex, copies), 200
+            finally:
+                release_printer(printer)
+        metrics.inc('copyrest_copies_total', status=ret[1], printer=printer['name'])
+        return ret
+
+    @staticmethod
+    def _scan(stack, scanner, input_source, color_mode, resolution, intent):
+        """
+        Every document of the scan is spooled to UPLOAD_FOLDER (removed when the stack is closed), to be printed
+        as one job, so duplex and collated copies work across the pages of the feeders which return each page
+        as a separate document. Returns the list of (file, filename) or the error response
+        """
+        scanner_ip = scanner['ip']
+        status = None
+        documents = []
+        try:
+            msg, status = ESCLScanner.scan(scanner_ip, input_source, None, None, color_mode, resolution, 'PDF',
+                                           intent)
+            if status != 201:
+                return 'Some parameters are wrong: {0}'.format(msg), status
+
+            while True:
+                with metrics.timed('copyrest_phase_seconds', 'first_byte'):
+                    response = ESCLScanner.next_document(scanner_ip, msg, scanner['cancel'])
+                if response.status_code == 404:  # No more pages
+                    response.close()
+                    break
+                if response.status_code != 200:  # A jam or a failure, the partial stack is not printed
+                    response.close()
+                    ESCLScanner.cancel_job(scanner_ip, msg)
+                    return 'The scanner stopped sending documents after {0}: {1} {2}'.format(
+                        len(documents), response.status_code, response.reason), 502
+                pdf_filename = 'copy_{0}.pdf'.format(len(documents) + 1)
+                fh = stack.enter_context(tempfile.NamedTemporaryFile(dir=printrest.UPLOAD_FOLDER,
+                                                                     suffix='_{0}'.format(pdf_filename)))
+                try:
+                    with metrics.timed('copyrest_phase_seconds', 'download'):
+                        for chunk in response.iter_content(printrest.CHUNK_SIZE):
+                            fh.write(chunk)
+                finally:
+                    response.close()
+                fh.flush()
+                fh.seek(0)
+                documents.append((fh, pdf_filename))
+        except (RequestException, HTTPError) as e:
+            if status == 201:
+                ESCLScanner.cancel_job(scanner_ip, msg)
+            return 'Scanner is not reachable: {0}'.format(e), 503
+        except ScanAborted as e:
+            return e.message, e.status_code
+
+        if len(documents) == 0:
+            return 'The scanner did not return any document.', 502
+        return documents
+
+
+def init_app(app):
+    app.register_blueprint(blueprint)
+
+
+def warm_up():
+    # The form lists the scanners and printers (which starts their pollers), the devices are warmed up by their services
+    pages.get('copy', None, CopyREST._render_form)
+    return {}
+
+
+__getattr__ = application.lazy_app(__name__)  # from copyrest import app
+
+
+if __name__ == '__main__':
+    application.service_app('copyrest').run(debug=False)
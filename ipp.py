@@ -0,0 +1,316 @@
+#!/usr/bin/python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+import getpass
+import itertools
+import threading
+from struct import pack, unpack_from, error as StructError
+from urllib.parse import urlsplit, urlunsplit
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+HTTP_TIMEOUT = (3.05, 300)  # Connect and read timeouts in seconds for the requests sent to the printer
+HTTP_RETRIES = 3  # Times to retry when the connection to the printer can not be made
+CHUNK_SIZE = 64 * 1024  # Bytes of the document held in memory at once while sending it
+
+
+class IPPError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__('{0} (0x{1:04x}): {2}'.format(IPPPrinter.status_code_names.get(status_code, 'unknown'),
+                                                       status_code, message))
+        self.status_code = status_code
+
+
+class IPPResponse:
+    """
+    The decoded response: the attribute groups are name -> list of values dicts
+    (the first one of each group is kept when a group is repeated)
+    """
+    def __init__(self, version, status_code, request_id, groups):
+        self.version = version
+        self.status_code = status_code
+        self.request_id = request_id
+        self.groups = groups
+
+    @property
+    def ok(self):
+        return self.status_code < 0x0100
+
+    @property
+    def status(self):
+        return IPPPrinter.status_code_names.get(self.status_code, '0x{0:04x}'.format(self.status_code))
+
+    @property
+    def status_message(self):
+        return self.get('operation', 'status-message', self.status)
+
+    def group(self, name):
+        for tag, attributes in self.groups:
+            if tag == IPPPrinter.group_tags[name]:
+                return attributes
+        return {}
+
+    def get(self, group, name, default=None):
+        values = self.group(group).get(name)
+        if not values:
+            return default
+        return values[0]
+
+    @property
+    def job_id(self):
+        return self.get('job', 'job-id')
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise IPPError(self.status_code, self.status_message)
+
+
+class IPPPrinter:
+    """
+    A minimal IPP/1.1 client (RFC 8010, RFC 8011) for the operations needed to print a document
+    """
+    version = (1, 1)
+
+    operations = {'Print-Job': 0x0002, 'Create-Job': 0x0005, 'Send-Document': 0x0006, 'Cancel-Job': 0x0008,
+                  'Get-Job-Attributes': 0x0009, 'Get-Printer-Attributes': 0x000b}
+    group_tags = {'operation': 0x01, 'job': 0x02, 'end': 0x03, 'printer': 0x04, 'unsupported': 0x05}
+    value_tags = {'unsupported': 0x10, 'unknown': 0x12, 'no-value': 0x13,
+                  'integer': 0x21, 'boolean': 0x22, 'enum': 0x23,
+                  'octetString': 0x30, 'dateTime': 0x31, 'resolution': 0x32, 'rangeOfInteger': 0x33,
+                  'textWithLanguage': 0x35, 'nameWithLanguage': 0x36,
+                  'textWithoutLanguage': 0x41, 'nameWithoutLanguage': 0x42, 'keyword': 0x44, 'uri': 0x45,
+                  'uriScheme': 0x46, 'charset': 0x47, 'naturalLanguage': 0x48, 'mimeMediaType': 0x49}
+    status_code_names = {0x0000: 'successful-ok', 0x0001: 'successful-ok-ignored-or-substituted-attributes',
+                         0x0002: 'successful-ok-conflicting-attributes',
+                         0x0400: 'client-error-bad-request', 0x0401: 'client-error-forbidden',
+                         0x0402: 'client-error-not-authenticated', 0x0403: 'client-error-not-authorized',
+                         0x0404: 'client-error-not-possible', 0x0405: 'client-error-timeout',
+                         0x0406: 'client-error-not-found', 0x0407: 'client-error-gone',
+                         0x0408: 'client-error-request-entity-too-large',
+                         0x040a: 'client-error-document-format-not-supported',
+                         0x040b: 'client-error-attributes-or-values-not-supported',
+                         0x0500: 'server-error-internal-error', 0x0501: 'server-error-operation-not-supported',
+                         0x0502: 'server-error-service-unavailable', 0x0503: 'server-error-version-not-supported',
+                         0x0504: 'server-error-device-error', 0x0505: 'server-error-temporary-error',
+                         0x0506: 'server-error-not-accepting-jobs', 0x0507: 'server-error-busy',
+                         0x0508: 'server-error-job-canceled',
+                         0x0509: 'server-error-multiple-document-jobs-not-supported'}
+    printer_states = {3: 'idle', 4: 'processing', 5: 'stopped'}
+    job_states = {3: 'pending', 4: 'pending-held', 5: 'processing', 6: 'processing-stopped', 7: 'canceled',
+                  8: 'aborted', 9: 'completed'}
+
+    _integer_tags = {0x21, 0x23}
+    _string_tags = {0x41, 0x42, 0x44, 0x45, 0x46, 0x47, 0x48, 0x49}
+
+    _request_ids = itertools.count(1)
+
+    # http(s) URL of the printer -> requests.Session with its own keep-alive connection pool
+    _sessions = {}
+    _sessions_lock = threading.Lock()
+
+    @staticmethod
+    def http_url(printer_uri):
+        # ipp://host/path is http://host:631/path (RFC 3510), ipps:// is the same over TLS
+        uri = urlsplit(printer_uri)
+        if uri.scheme in {'ipp', 'ipps'}:
+            netloc = uri.netloc if uri.port is not None else '{0}:631'.format(uri.netloc)
+            uri = uri._replace(scheme={'ipp': 'http', 'ipps': 'https'}[uri.scheme], netloc=netloc)
+        return urlunsplit(uri)
+
+    @staticmethod
+    def session(printer_uri):
+        url = IPPPrinter.http_url(printer_uri)
+        with IPPPrinter._sessions_lock:
+            session = IPPPrinter._sessions.get(url)
+            if session is None:
+                # Every operation is a POST, which is only retried when it could not be sent at all
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4,
+                                      max_retries=Retry(total=HTTP_RETRIES, connect=HTTP_RETRIES, read=0, status=0,
+                                                        backoff_factor=0.1, raise_on_status=False))
+                session = Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                IPPPrinter._sessions[url] = session
+            return session
+
+    @staticmethod
+    def _encode_value(value_tag, value):
+        if value_tag in IPPPrinter._integer_tags:
+            return pack('>i', value)
+        elif value_tag == 0x22:
+            return pack('>?', value)
+        elif value_tag == 0x33:
+            return pack('>ii', *value)
+        elif value_tag == 0x32:
+            return pack('>iib', *value)
+        elif value_tag in {0x10, 0x12, 0x13}:
+            return b''
+        elif isinstance(value, bytes):
+            return value
+        return str(value).encode('UTF-8')
+
+    @staticmethod
+    def _decode_value(value_tag, value):
+        if value_tag in IPPPrinter._integer_tags:
+            return unpack_from('>i', value)[0]
+        elif value_tag == 0x22:
+            return value != b'\x00'
+        elif value_tag == 0x33:
+            return unpack_from('>ii', value)
+        elif value_tag == 0x32:
+            return unpack_from('>iib', value)
+        elif value_tag in {0x10, 0x12, 0x13}:
+            return None
+        elif value_tag in IPPPrinter._string_tags:
+            return value.decode('UTF-8', errors='replace')
+        return value
+
+    @staticmethod
+    def encode(code, request_id, groups, version=None):
+        """
+        code is the operation-id in requests and the status-code in responses,
+        groups is a list of (group name, [(value tag name, attribute name, value or list of values), ...])
+        """
+        major, minor = version or IPPPrinter.version
+        out = [pack('>bbHi', major, minor, code, request_id)]
+        for group, attributes in groups:
+            out.append(pack('>b', IPPPrinter.group_tags[group]))
+            for value_tag_name, name, values in attributes:
+                value_tag = IPPPrinter.value_tags[value_tag_name]
+                if not isinstance(values, list):
+                    values = [values]
+                for i, value in enumerate(values):
+                    name_bytes = name.encode('UTF-8') if i == 0 else b''  # additional-value has no name
+                    value_bytes = IPPPrinter._encode_value(value_tag, value)
+                    out.append(pack('>bh', value_tag, len(name_bytes)))
+                    out.append(name_bytes)
+                    out.append(pack('>h', len(value_bytes)))
+                    out.append(value_bytes)
+        out.append(pack('>b', IPPPrinter.group_tags['end']))
+        return b''.join(out)
+
+    @staticmethod
+    def decode(data):
+        """
+        Returns (version, code, request_id, [(group tag, {name: [values]}), ...], offset of the data after the message).
+        Raises IPPError if data is not a complete IPP message
+        """
+        try:
+            return IPPPrinter._decode(data)
+        except (StructError, IndexError, KeyError, TypeError, ValueError) as e:
+            raise IPPError(0x0400, 'Malformed IPP message ({0!r}...): {1}'.format(bytes(data[:16]), e)) from e
+
+    @staticmethod
+    def _decode(data):
+        major, minor, code, request_id = unpack_from('>bbHi', data)
+        if major not in {1, 2}:
+            raise ValueError('unknown version {0}.{1}'.format(major, minor))
+        offset = 8
+        groups = []
+        attributes = None
+        name = None
+        while True:
+            tag = data[offset]
+            offset += 1
+            if tag == IPPPrinter.group_tags['end']:
+                break
+            elif tag < 0x10:
+                attributes = {}
+                groups.append((tag, attributes))
+                continue
+            name_length = unpack_from('>H', data, offset)[0]
+            offset += 2
+            if name_length > 0:
+                name = data[offset:offset + name_length].decode('UTF-8')
+                offset += name_length
+            value_length = unpack_from('>H', data, offset)[0]
+            offset += 2
+            value = IPPPrinter._decode_value(tag, data[offset:offset + value_length])
+            offset += value_length
+            if name_length > 0:
+                attributes[name] = [value]
+            else:
+                attributes[name].append(value)
+        return (major, minor), code, request_id, groups, offset
+
+    @staticmethod
+    def _operation_attributes(printer_uri, user=None):
+        return [('charset', 'attributes-charset', 'utf-8'), ('naturalLanguage', 'attributes-natural-language', 'en'),
+                ('uri', 'printer-uri', printer_uri),
+                ('nameWithoutLanguage', 'requesting-user-name', user or getpass.getuser())]
+
+    @staticmethod
+    def _body(message, document):
+        yield message
+        if isinstance(document, bytes):
+            yield document
+        elif document is not None:
+            chunk = document.read(CHUNK_SIZE)
+            while len(chunk) > 0:
+                yield chunk
+                chunk = document.read(CHUNK_SIZE)
+
+    @staticmethod
+    def request(printer_uri, operation, groups, document=None, timeout=None):
+        """
+        Documents (bytes or binary file-like objects) are streamed after the IPP message with chunked encoding
+        """
+        message = IPPPrinter.encode(IPPPrinter.operations[operation], next(IPPPrinter._request_ids), groups)
+        data = message if document is None else IPPPrinter._body(message, document)
+        resp = IPPPrinter.session(printer_uri).post(IPPPrinter.http_url(printer_uri), data=data,
+                                                    headers={'Content-Type': 'application/ipp'},
+                                                    timeout=timeout or HTTP_TIMEOUT)
+        resp.raise_for_status()
+        version, status_code, request_id, groups, _ = IPPPrinter.decode(resp.content)
+        return IPPResponse(version, status_code, request_id, groups)
+
+    @staticmethod
+    def create_job(printer_uri, job_attributes, job_name=None, user=None):
+        operation_attributes = IPPPrinter._operation_attributes(printer_uri, user)
+        if job_name is not None:
+            operation_attributes.append(('nameWithoutLanguage', 'job-name', job_name))
+        return IPPPrinter.request(printer_uri, 'Create-Job', [('operation', operation_attributes),
+                                                              ('job', job_attributes)])
+
+    @staticmethod
+    def send_document(printer_uri, job_id, document, last_document=True, document_format='application/pdf',
+                      document_name=None, user=None):
+        operation_attributes = IPPPrinter._operation_attributes(printer_uri, user)
+        operation_attributes.extend([('integer', 'job-id', job_id), ('boolean', 'last-document', last_document),
+                                     ('mimeMediaType', 'document-format', document_format)])
+        if document_name is not None:
+            operation_attributes.append(('nameWithoutLanguage', 'document-name', document_name))
+        return IPPPrinter.request(printer_uri, 'Send-Document', [('operation', operation_attributes)], document)
+
+    @staticmethod
+    def cancel_job(printer_uri, job_id, user=None):
+        operation_attributes = IPPPrinter._operation_attributes(printer_uri, user)
+        operation_attributes.append(('integer', 'job-id', job_id))
+        return IPPPrinter.request(printer_uri, 'Cancel-Job', [('operation', operation_attributes)])
+
+    @staticmethod
+    def get_job_attributes(printer_uri, job_id, requested_attributes=None, user=None):
+        operation_attributes = IPPPrinter._operation_attributes(printer_uri, user)
+        operation_attributes.append(('integer', 'job-id', job_id))
+        if requested_attributes is not None:
+            operation_attributes.append(('keyword', 'requested-attributes', list(requested_attributes)))
+        return IPPPrinter.request(printer_uri, 'Get-Job-Attributes', [('operation', operation_attributes)])
+
+    @staticmethod
+    def get_printer_attributes(printer_uri, requested_attributes=None, user=None, timeout=None):
+        operation_attributes = IPPPrinter._operation_attributes(printer_uri, user)
+        if requested_attributes is not None:
+            operation_attributes.append(('keyword', 'requested-attributes', list(requested_attributes)))
+        return IPPPrinter.request(printer_uri, 'Get-Printer-Attributes', [('operation', operation_attributes)],
+                                  timeout=timeout)
+
+    @staticmethod
+    def page_ranges(page_range):
+        # '1-5,8' -> [(1, 5), (8, 8)]
+        ranges = []
+        for part in page_range.split(','):
+            first, _, last = part.partition('-')
+            ranges.append((int(first), int(last or first)))
+        return ranges
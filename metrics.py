@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+import time
+import logging
+import threading
+from json import dumps
+from contextlib import contextmanager
+
+from flask import Response, g, request, has_request_context
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)  # Histogram buckets in seconds
+TIMING_LOG = False  # Log a JSON line with the duration of every phase for each request
+
+timing_logger = logging.getLogger('timing')
+
+# (name, sorted label items) -> bucket counts followed by the sum and the count of the observations
+_histograms = {}
+# (name, sorted label items) -> value
+_counters = {}
+# lock to control access to variable
+_metrics_lock = threading.Lock()
+
+
+def observe(name, seconds, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        values = _histograms.get(key)
+        if values is None:
+            values = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                values[i] += 1
+        values[-2] += seconds
+        values[-1] += 1
+
+
+def inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def add_timing(phase, seconds):
+    # Collected for the timing log line of the current request (if any)
+    if has_request_context():
+        timings = g.setdefault('timings', {})
+        timings[phase] = timings.get(phase, 0) + seconds
+
+
+@contextmanager
+def timed(name, phase, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe(name, elapsed, phase=phase, **labels)
+        add_timing(phase, elapsed)
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if len(labels) == 0:
+        return ''
+    return '{{{0}}}'.format(','.join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                     for k, v in labels))
+
+
+def exposition():
+    # Prometheus text format (version 0.0.4)
+    with _metrics_lock:
+        histograms = sorted((k, list(v)) for k, v in _histograms.items())
+        counters = sorted(_counters.items())
+
+    lines = []
+    last_name = None
+    for (name, labels), value in counters:
+        if name != last_name:
+            lines.append('# TYPE {0} counter'.format(name))
+            last_name = name
+        lines.append('{0}{1} {2}'.format(name, _format_labels(labels), value))
+    for (name, labels), values in histograms:
+        if name != last_name:
+            lines.append('# TYPE {0} histogram'.format(name))
+            last_name = name
+        for bound, count in zip(BUCKETS, values):  # The buckets are cumulative already
+            lines.append('{0}_bucket{1} {2}'.format(name, _format_labels(labels, [('le', bound)]), count))
+        lines.append('{0}_bucket{1} {2}'.format(name, _format_labels(labels, [('le', '+Inf')]), values[-1]))
+        lines.append('{0}_sum{1} {2}'.format(name, _format_labels(labels), values[-2]))
+        lines.append('{0}_count{1} {2}'.format(name, _format_labels(labels), values[-1]))
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def account_requests(app, service):
+    """
+    Per-request accounting for an app or a blueprint (its requests only): {service}_requests_total and
+    {service}_request_seconds are recorded when the response is closed, so streamed bodies are included
+    """
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+        g.timings = {}
+
+    @app.after_request
+    def account(response):
+        started = g.get('request_started')
+        if started is None:  # The request failed before it could be timed
+            return response
+        timings = g.timings
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unknown'
+        method = request.method
+        path = request.path
+
+        def finished():
+            elapsed = time.perf_counter() - started
+            observe('{0}_request_seconds'.format(service), elapsed, endpoint=endpoint, method=method)
+            inc('{0}_requests_total'.format(service), endpoint=endpoint, method=method, status=response.status_code)
+            if TIMING_LOG:
+                timing_logger.info(dumps({'service': service, 'method': method, 'path': path,
+                                          'status': response.status_code, 'seconds': round(elapsed, 4),
+                                          'phases': {k: round(v, 4) for k, v in timings.items()}}))
+
+        response.call_on_close(finished)
+        return response
+
+
+def init_app(app):
+    # Adds /metrics with the metrics of every service of the process
+    @app.route('/metrics')
+    def metrics():
+        return Response(exposition(), mimetype='text/plain; version=0.0.4')
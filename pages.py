@@ -0,0 +1,55 @@
+#!/usr/bin/python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+import gzip
+import hashlib
+import threading
+
+from flask import Response, request
+
+PAGE_MAX_AGE = 0  # Seconds browsers may reuse a page without asking (0 to revalidate it with its ETag every time)
+
+
+class PageCache:
+    """
+    Rendered pages with a strong ETag and a gzip-compressed copy, a page is rendered again only when its key
+    changes (the key is kept, so the same object can be used as the key, e.g. the cached capabilities)
+    """
+    def __init__(self):
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    def get(self, name, key, render):
+        with self._lock:
+            page = self._pages.get(name)
+        if page is not None and (page['key'] is key or page['key'] == key):
+            return page
+
+        body = render().encode('UTF-8')
+        page = {'key': key, 'body': body, 'gzip': gzip.compress(body, 9),
+                'etag': hashlib.sha256(body).hexdigest()[:32]}
+        with self._lock:
+            self._pages[name] = page
+        return page
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+
+def page_response(page):
+    # Conditional requests with a matching ETag get 304, the compressed copy has its own ETag as it is another body
+    compressed = request.accept_encodings['gzip'] > 0
+    if compressed:
+        resp = Response(page['gzip'], mimetype='text/html')
+        resp.headers['Content-Encoding'] = 'gzip'
+        resp.set_etag('{0}-gzip'.format(page['etag']))
+    else:
+        resp = Response(page['body'], mimetype='text/html')
+        resp.set_etag(page['etag'])
+    resp.vary.add('Accept-Encoding')
+    if PAGE_MAX_AGE > 0:
+        resp.cache_control.max_age = PAGE_MAX_AGE
+    else:
+        resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+import time
+import itertools
+import threading
+from json import dumps
+
+from flask import Response, request, jsonify
+
+LONG_POLL_TIMEOUT = 60  # Longest seconds a state request with ?wait= is held open
+HEARTBEAT = 15  # Seconds between two keep-alive comments on an idle event stream
+
+# Notified whenever the state of any polled device changes
+changed = threading.Condition()
+# Every change gets the next version, so a single number tells which changes a client has seen on all devices
+_versions = itertools.count(1)
+
+
+class StatePoller:
+    """
+    Queries the state of a device in a background thread. The interval starts at the shorter of the two
+    intervals, doubles while the state stays the same and drops back when it changes or the device is busy.
+    Readers get the last known state at once
+    """
+    def __init__(self, name, fetch, intervals, busy=None):
+        self.name = name
+        self._fetch = fetch
+        self._min_interval, self._max_interval = intervals
+        self._busy = busy or (lambda state: False)
+        self._poke = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._snapshot = {'name': name, 'state': None, 'error': None, 'version': 0, 'updated_at': None}
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='poller-{0}'.format(self.name), daemon=True)
+                self._thread.start()
+        return self
+
+    def poke(self):
+        # Query the device now (e.g. when a job was just started on it)
+        self._poke.set()
+
+    def snapshot(self):
+        with changed:
+            return dict(self._snapshot)
+
+    def _run(self):
+        interval = self._min_interval
+        while True:
+            try:
+                state, error = self._fetch(), None
+            except Exception as e:  # The poller must survive any failure of the device
+                state, error = None, str(e)
+            with changed:
+                if state != self._snapshot['state'] or error != self._snapshot['error']:
+                    self._snapshot = {'name': self.name, 'state': state, 'error': error, 'version': next(_versions),
+                                      'updated_at': time.time()}
+                    changed.notify_all()
+                    interval = self._min_interval
+                else:
+                    self._snapshot['updated_at'] = time.time()
+                    interval = min(interval * 2, self._max_interval)
+            if self._busy(state):
+                interval = self._min_interval
+            self._poke.wait(interval)
+            self._poke.clear()
+
+
+def wait_for_change(pollers, since, timeout):
+    """
+    Snapshots of the devices which changed after version since, waiting at most timeout seconds for one.
+    Empty on timeout
+    """
+    deadline = time.monotonic() + timeout
+    with changed:
+        while True:
+            newer = [snapshot for snapshot in (poller.snapshot() for poller in pollers) if snapshot['version'] > since]
+            remaining = deadline - time.monotonic()
+            if len(newer) > 0 or remaining <= 0:
+                return newer
+            changed.wait(remaining)
+
+
+def event_stream(pollers, since):
+    """
+    Server-sent events: the current state of every device first (only the ones changed after since
+    when the client reconnects), then every change as it happens
+    """
+    newer = [snapshot for snapshot in (poller.snapshot() for poller in pollers) if snapshot['version'] > since]
+    while True:
+        if len(newer) == 0:
+            yield ': keep-alive\n\n'
+        for snapshot in sorted(newer, key=lambda s: s['version']):
+            since = max(since, snapshot['version'])
+            yield 'id: {0}\nevent: state\ndata: {1}\n\n'.format(snapshot['version'], dumps(snapshot))
+        newer = wait_for_change(pollers, since, HEARTBEAT)
+
+
+def state_response(pollers):
+    """
+    The last known state of the devices without querying them. With ?since=<version>&wait=<seconds>
+    the request is held until a device changes after the given version (long polling)
+    """
+    since = request.args.get('since', type=int)
+    wait = min(request.args.get('wait', 0, type=float), LONG_POLL_TIMEOUT)
+    if since is not None and wait > 0:
+        wait_for_change(pollers, since, wait)
+    snapshots = [poller.snapshot() for poller in pollers]
+    return jsonify(version=max([snapshot['version'] for snapshot in snapshots], default=0),
+                   devices={snapshot['name']: snapshot for snapshot in snapshots})
+
+
+def events_response(pollers):
+    # EventSource sends the id of the last event it got when it reconnects
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', 0, type=int)
+    return Response(event_stream(pollers, since), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Optional post-processing of scanned JPEG pages: straighten (deskew), trim the blank borders, downsample to
+a lower resolution and recompress. Needs NumPy and Pillow (pip install numpy Pillow), without them only the
+'none' profile is offered. The pages are processed in a pool of worker processes, so the request threads only
+wait for the result. Under gevent's monkey-patching (serve.py, gevent workers) the process pool would deadlock:
+its internal threads are greenlets blocking on its pipes. There the pages go to a pool of native threads instead,
+NumPy and Pillow release the GIL for most of the work
+"""
+
+import sys
+import threading
+from io import BytesIO
+from importlib.util import find_spec
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# NumPy and Pillow are imported by the worker processes with their first page, the request workers do not need them
+np = Image = None
+
+# Profile name -> settings, offered on the /scan form. dpi: target resolution (None to keep it),
+# quality: JPEG quality, max_bytes: the quality is lowered (down to 20) until the page fits (None for no limit)
+PROFILES = {'none': None,
+            'trimmed': {'deskew': True, 'trim': True, 'dpi': None, 'quality': 85, 'max_bytes': None},
+            'email': {'deskew': True, 'trim': True, 'dpi': 150, 'quality': 75, 'max_bytes': None},
+            'smallest': {'deskew': True, 'trim': True, 'dpi': 100, 'quality': 60, 'max_bytes': 300 * 1024}}
+WORKERS = 2  # Processes to run the post-processing in
+BLANK_LEVEL = 235  # Pixels lighter than this (0-255) count as blank paper
+MAX_SKEW = 5  # Largest skew in degrees corrected by deskewing
+SKEW_STEP = 0.25  # Precision of the skew detection in degrees
+
+_pool = None
+_pool_lock = threading.Lock()
+_available = None
+
+
+def available():
+    global _available
+    if _available is None:
+        _available = find_spec('numpy') is not None and find_spec('PIL') is not None
+    return _available
+
+
+def _import():
+    global np, Image
+    if np is None:
+        import numpy
+        from PIL import Image as pil_image
+        np, Image = numpy, pil_image
+
+
+def profile_names():
+    return [name for name, profile in PROFILES.items() if profile is None or available()]
+
+
+def _new_pool():
+    gevent_monkey = sys.modules.get('gevent.monkey')
+    if gevent_monkey is not None and gevent_monkey.is_module_patched('threading'):
+        from gevent.threadpool import ThreadPoolExecutor
+        return ThreadPoolExecutor(WORKERS)
+    return ProcessPoolExecutor(WORKERS)
+
+
+def submit(data, resolution, profile):
+    """
+    Future of the processed JPEG. A pool with a dead worker (killed, out of memory) refuses new pages, it is
+    replaced with a new one. If that fails too the future holds the page as it is
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = _new_pool()
+        pool = _pool
+    try:
+        return pool.submit(process_jpeg, data, resolution, profile)
+    except BrokenProcessPool:
+        pass
+    with _pool_lock:
+        if _pool is pool:  # Not replaced by another request yet
+            pool.shutdown(wait=False)
+            _pool = _new_pool()
+        pool = _pool
+    try:
+        return pool.submit(process_jpeg, data, resolution, profile)
+    except (BrokenProcessPool, OSError, RuntimeError):
+        future = Future()
+        future.set_result(data)
+        return future
+
+
+def process_jpeg(data, resolution, profile):
+    """
+    The processed JPEG, or the original if it could not be read or the result would not be smaller.
+    resolution is the scan resolution, used when the JPEG does not tell its own
+    """
+    _import()
+    try:
+        image = Image.open(BytesIO(data))
+        image.load()
+    except OSError:
+        return data
+    dpi = round(image.info.get('dpi', (resolution, resolution))[0]) or resolution
+    if image.mode not in {'L', 'RGB'}:
+        image = image.convert('RGB')
+
+    if profile['deskew']:
+        skew = _skew_angle(_ink(image), dpi)
+        if skew != 0:
+            fill = 255 if image.mode == 'L' else (255, 255, 255)
+            image = image.rotate(-skew, resample=Image.BICUBIC, expand=True, fillcolor=fill)
+    if profile['trim']:
+        image = _trim(image, dpi)
+    if profile['dpi'] is not None and profile['dpi'] < dpi:
+        size = (max(1, round(image.width * profile['dpi'] / dpi)), max(1, round(image.height * profile['dpi'] / dpi)))
+        image = image.resize(size, Image.LANCZOS)
+        dpi = profile['dpi']
+
+    quality = profile['quality']
+    out = _encode(image, dpi, quality)
+    while profile['max_bytes'] is not None and len(out) > profile['max_bytes'] and quality > 20:
+        quality = max(20, quality - 10)
+        out = _encode(image, dpi, quality)
+    if len(out) >= len(data):
+        return data
+    return out
+
+
+def _encode(image, dpi, quality):
+    out = BytesIO()
+    image.save(out, 'JPEG', quality=quality, optimize=True, dpi=(dpi, dpi))
+    return out.getvalue()
+
+
+def _ink(image):
+    # Boolean array of the pixels which are not blank paper
+    return np.asarray(image.convert('L')) < BLANK_LEVEL
+
+
+def _trim(image, dpi):
+    # Crop to the rows and columns with ink (ignoring specks), leaving a margin of 1/20 inch
+    ink = _ink(image)
+    rows = np.flatnonzero(ink.mean(axis=1) > 0.002)
+    cols = np.flatnonzero(ink.mean(axis=0) > 0.002)
+    if len(rows) == 0 or len(cols) == 0:
+        return image  # Blank page
+    margin = dpi // 20
+    return image.crop((max(0, cols[0] - margin), max(0, rows[0] - margin),
+                       min(image.width, cols[-1] + 1 + margin), min(image.height, rows[-1] + 1 + margin)))
+
+
+def _skew_angle(ink, dpi):
+    """
+    How many degrees the lines of text are rotated counterclockwise (0 if straight): the ink is projected
+    onto the rows for every candidate angle at once, and the angle with the sharpest row profile (largest sum
+    of squared differences between neighbouring rows) wins. Works on a ~50 dpi sample of the ink
+    """
+    step = max(1, dpi // 50)
+    ys, xs = np.nonzero(ink[::step, ::step])
+    if len(ys) < 100:
+        return 0
+    if len(ys) > 200000:
+        keep = np.random.default_rng(0).choice(len(ys), 200000, replace=False)
+        ys, xs = ys[keep], xs[keep]
+    angles = np.arange(-MAX_SKEW, MAX_SKEW + SKEW_STEP / 2, SKEW_STEP)
+    rows = np.rint(ys[None, :] + xs[None, :] * np.tan(np.radians(angles))[:, None]).astype(np.int64)
+    rows -= rows.min()
+    height = rows.max() + 1
+    profiles = np.bincount((rows + np.arange(len(angles))[:, None] * height).ravel(),
+                           minlength=len(angles) * height).reshape(len(angles), height)
+    scores = (np.diff(profiles, axis=1).astype(np.float64) ** 2).sum(axis=1)
+    best = angles[np.argmax(scores)]
+    if abs(best) < SKEW_STEP or scores.max() <= scores[len(angles) // 2] * 1.01:
+        return 0
+    return float(best)
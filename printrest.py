@@ -3,39 +3,124 @@
 
 import os
 import re
+import json
+import time
+import uuid
+import fcntl
+import queue
+import hashlib
+import shutil
+import tempfile
 import threading
+import itertools
 import subprocess
+from io import BytesIO
+from functools import partial
+from contextlib import ExitStack, nullcontext
 
-from flask import Flask, request
-from flask_restful import Resource, Api
+from flask import Blueprint, Request, request, jsonify, url_for
+from flask_restful import Resource
 from werkzeug import secure_filename
+from werkzeug.exceptions import ClientDisconnected
+from requests import RequestException
+
+import metrics
+import application
+from pages import PageCache, page_response
+from poller import StatePoller, state_response, events_response
+from ipp import IPPPrinter, IPPError, CHUNK_SIZE
+
 
 UPLOAD_FOLDER = '/tmp/'
+MAX_CONTENT_LENGTH = 100 * 1024 * 1024  # Largest request body (upload) accepted
 ALLOWED_EXTENSIONS = {'pdf'}
 
-lp = False
-if lp:
-    # lp options. May need to be customized for your printer!
-    PRINTER = 'default'  # Printer name from lpstat -p -d or 'default' for the system's default printer
-    DUPLEX_OPTIONS = {'none': '', 'long': '-o sides=two-sided-long-edge', 'short': '-o sides=two-sided-short-edge'}
-    ORIENTATION = {'portrait': '-o orientation-requested=3', 'landscape': '-o orientation-requested=4'}
-else:
-    # ipp options. May need to be customized for your printer!
-    PRINTER = '192.168.x.x'  # Printer ip or DNS eg. 192.168.x.x if ipp://192.168.x.x/ipp/print is the IPP URL
-    DUPLEX_OPTIONS = {'none': 'one-sided', 'long': 'two-sided-long-edge', 'short': 'two-sided-short-edge'}
-    ORIENTATION = {'portrait': '3', 'landscape': '4'}
+QUEUED = False  # Answer with a job id as soon as the upload is saved and send the jobs to the printer in the background
+PRINT_WORKERS = 1  # Background threads sending the queued jobs to the printer
+JOB_RETENTION = 3600  # Seconds to keep the status of the finished jobs
+DEDUP_WINDOW = 60  # Seconds in which the same document with the same options is printed only once (0 to disable)
+UPLOAD_SESSION_TTL = 24 * 3600  # Seconds an unfinished resumable upload is kept after its last chunk
+UPLOAD_MAX_LENGTH = 1024 * 1024 * 1024  # Largest document accepted by the resumable uploads
+
+BACKEND = 'ipp'  # 'ipp' to send the jobs to the printer over IPP or 'lp' to print them through CUPS
+# ipp: printer ip or DNS eg. 192.168.x.x if ipp://192.168.x.x/ipp/print is the IPP URL,
+# lp: printer name from lpstat -p -d or 'default' for the system's default printer
+PRINTER = '192.168.x.x'
+
+# lp options. May need to be customized for your printer!
+LP_DUPLEX_OPTIONS = {'none': '', 'long': '-o sides=two-sided-long-edge', 'short': '-o sides=two-sided-short-edge'}
+LP_ORIENTATION = {'portrait': '-o orientation-requested=3', 'landscape': '-o orientation-requested=4'}
+
+# ipp options. May need to be customized for your printer!
+IPP_BACKEND = 'native'  # 'native' for the built-in IPP client or 'ipptool' to run /usr/bin/ipptool for every job
+# Longer PDFs are sent by the native backend as parts of this many pages in one job, so the printer can start
+# before the whole document is sent (0 to disable, needs pypdf)
+PROGRESSIVE_CHUNK_PAGES = 0
+PROGRESSIVE_RETRIES = 3  # Times a part refused by the printer with a server error (e.g. busy) is sent again
+# The server errors of Send-Document that tell that the part was not accepted for now: service-unavailable,
+# device-error, temporary-error, not-accepting-jobs and busy
+PROGRESSIVE_RETRY_STATUSES = {0x0502, 0x0504, 0x0505, 0x0506, 0x0507}
+IPP_DUPLEX_OPTIONS = {'none': 'one-sided', 'long': 'two-sided-long-edge', 'short': 'two-sided-short-edge'}
+IPP_ORIENTATION = {'portrait': '3', 'landscape': '4'}
 
+# Printer pool: name -> printer (like PRINTER above or an ipp:// URI), only PRINTER is used when it is empty
+PRINTERS = {}
+# Interchangeable printers: class name -> printer names, a job sent to a class goes to its least loaded member
+PRINTER_CLASSES = {}
+PRINTER_STATE_TTL = 5  # Seconds to reuse the printer-state of a printer when choosing where to send a job
+PRINTER_PROBE_TIMEOUT = (1, 2)  # Connect and read timeouts in seconds for the printer-state query
+# Admission control: jobs for printers that are stopped, report one of these printer-state-reasons (without the
+# -error, -warning or -report suffix) or have this many jobs queued (on the printer and by us) are answered with 503
+# and Retry-After before the upload is read, if no other printer can take them. A printer in an unknown state is used
+ADMISSION = {'reject_stopped': True, 'max_queued_jobs': 20, 'retry_after': 60,
+             'reject_reasons': {'media-empty', 'media-needed', 'media-jam', 'toner-empty', 'marker-supply-empty',
+                                'door-open', 'cover-open', 'paused', 'offline'}}
+PRINTER_ADMISSION = {}  # printer name -> the ADMISSION settings which are different for the printer
+PRINTER_POLLING = True  # Keep the state of every printer up to date in the background (GET /print/state, /print/events)
+POLL_INTERVALS = (2, 60)  # Shortest and longest seconds between two printer-state queries, the longest while idle
 
 RANGE_RE = re.compile('([0-9]+(-[0-9]+)?)(,([0-9]+(-[0-9]+)?))*$')
+CONTENT_RANGE_RE = re.compile(r'bytes ([0-9]+)-([0-9]+)/([0-9]+|\*)$')
+UPLOAD_ID_RE = re.compile('[0-9a-f]{32}$')
+
+# name -> printer state (lock, queue of the queued mode, number of jobs assigned to it, last known printer-state,
+# the background poller of the state)
+printers = {}
+printers_lock = threading.Lock()
+
+# Queued mode: job_id -> job status, the workers of a printer are started with its first queued job
+print_jobs = {}
+print_jobs_lock = threading.Lock()
+
+# (SHA-256 of the document, print options) -> recent submission
+submissions = {}
+submissions_lock = threading.Lock()
+
+
+class HashingFile:
+    """
+    Spooled upload which computes the SHA-256 of the document while werkzeug writes it
+    """
+    def __init__(self, fh):
+        self._fh = fh
+        self.sha256 = hashlib.sha256()
 
-# lock to control access to variable
-print_lock = threading.Lock()
+    def write(self, data):
+        self.sha256.update(data)
+        return self._fh.write(data)
 
+    def __getattr__(self, name):
+        return getattr(self._fh, name)
 
-app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024
-api = Api(app)
+
+class HashingRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingFile(super()._get_file_stream(total_content_length, content_type, filename, content_length))
+
+
+blueprint = Blueprint('printrest', __name__)
+metrics.account_requests(blueprint, 'printrest')
+pages = PageCache()
 
 print_upload_form = """
 <!DOCTYPE html>
@@ -86,6 +171,12 @@ form {
        Copies: <br/>
        <input type="number" name="copies" placeholder="1">
     </p>
+    <p>
+       Printer: <br/>
+       <select name="printer" onchange="this.form.action = '?printer=' + encodeURIComponent(this.value)">
+PRINTER_OPTIONS_PLACEHOLDER
+       </select>
+    </p>
     <p>
         <input type="submit" value="Print" name="submit">
     </p>
@@ -96,44 +187,247 @@ form {
 """
 
 
-def print_lp(duplex, page_range, orientation, copies, pdf, pdf_filename):
-    command = ['lp']
+def document_path(pdf):
+    # Path of the document when it is a file on disk already (e.g. a queued job), None for streams
+    name = getattr(pdf, 'name', None)
+    if isinstance(name, str) and os.path.isfile(name):
+        return name
+    return None
+
+
+def seekable(pdf):
+    # Whether the document can be read more than once (files and spooled uploads), not the raw request body
+    try:
+        return pdf.seekable()
+    except (AttributeError, OSError, ValueError):
+        return False
+
+
+def lp_command(printer_name, duplex, page_range, orientation, copies, pdf_filename):
+    command = ['lp', '-t', pdf_filename]
 
-    if PRINTER != 'default':
-        command.extend(['-d', PRINTER])
+    if printer_name != 'default':
+        command.extend(['-d', printer_name])
 
     if duplex != 'none':
-        command.extend(DUPLEX_OPTIONS[duplex].split())
+        command.extend(LP_DUPLEX_OPTIONS[duplex].split())
 
     if len(page_range) > 0:
         command.extend(['-o', 'page-ranges=' + page_range])
 
-    command.extend(ORIENTATION[orientation].split())
+    command.extend(LP_ORIENTATION[orientation].split())
 
     if copies > 1:
         command.extend(['-n', str(copies)])
+    return command
 
-    pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], pdf_filename)
-    command.append(pdf_path)
 
-    pdf.save(pdf_path)
-    ret = subprocess.run(command, stderr=subprocess.PIPE)
-    os.remove(pdf_path)
+def print_lp(printer_name, duplex, page_range, orientation, copies, pdf, pdf_filename):
+    command = lp_command(printer_name, duplex, page_range, orientation, copies, pdf_filename)
 
+    # lp reads the document from its standard input when no file is given
+    with metrics.timed('printrest_phase_seconds', 'lp'):
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            shutil.copyfileobj(pdf, proc.stdin, CHUNK_SIZE)
+            proc.stdin.close()
+        except BrokenPipeError:  # lp exited early, its error message tells why
+            pass
+        err_msg = proc.stderr.read().decode('UTF-8').rstrip()
+        proc.stderr.close()
+        returncode = proc.wait()
+
+    if returncode != 0:
+        return 'Printing error: {0}'.format(err_msg), 500
+    return None
+
+
+def print_lp_files(printer_name, duplex, page_range, orientation, copies, pdf_paths, title):
+    # All files given to one lp command are printed as one job
+    command = lp_command(printer_name, duplex, page_range, orientation, copies, title)
+    with metrics.timed('printrest_phase_seconds', 'lp'):
+        ret = subprocess.run(command + ['--'] + pdf_paths, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE)
     if ret.returncode != 0:
         err_msg = ret.stderr.decode('UTF-8').rstrip()
         return 'Printing error: {0}'.format(err_msg), 500
     return None
 
 
+def get_printer_uri(printer_address):
+    if '://' in printer_address:
+        return printer_address
+    return 'ipp://{0}/ipp/print'.format(printer_address)
+
+
 def print_ipp(printer_address, duplex, page_range, orientation, copies, pdf, pdf_filename):
-    printer_uri = 'ipp://{0}/ipp/print'.format(printer_address)
+    printer_uri = get_printer_uri(printer_address)
+    if IPP_BACKEND == 'ipptool':
+        pdf_path = document_path(pdf)
+        if pdf_path is not None:
+            return print_ipptool(printer_uri, duplex, page_range, orientation, copies, [pdf_path])
+        # ipptool needs a path, the temporary file is removed even if printing fails
+        with tempfile.NamedTemporaryFile(dir=UPLOAD_FOLDER, suffix='_{0}'.format(pdf_filename)) as fh:
+            with metrics.timed('printrest_phase_seconds', 'save'):
+                shutil.copyfileobj(pdf, fh, CHUNK_SIZE)
+                fh.flush()
+            return print_ipptool(printer_uri, duplex, page_range, orientation, copies, [fh.name])
+
+    if PROGRESSIVE_CHUNK_PAGES > 0 and seekable(pdf):  # The uploads are spooled by werkzeug before the view runs
+        pages = progressive_pages(pdf, page_range)
+        if pages is not None:
+            return print_ipp_progressive(printer_uri, duplex, orientation, copies, pdf_filename, *pages)
+
+    job_id = None
+    try:
+        with metrics.timed('printrest_phase_seconds', 'ipp_create_job'):
+            resp = IPPPrinter.create_job(printer_uri, ipp_job_attributes(duplex, page_range, orientation, copies))
+        resp.raise_for_status()
+        job_id = resp.job_id
+        with metrics.timed('printrest_phase_seconds', 'ipp_send_document'):
+            resp = IPPPrinter.send_document(printer_uri, job_id, pdf, document_name=pdf_filename)
+        resp.raise_for_status()
+    except (IPPError, RequestException) as e:
+        cancel_ipp_job(printer_uri, job_id)
+        return 'Printing error: {0}'.format(e), 500
+    return None
+
+
+def print_ipp_batch(printer_address, duplex, page_range, orientation, copies, documents):
+    """
+    One Create-Job and a Send-Document for each (pdf, pdf_filename) in documents, only the last one is sent
+    with last-document true. Returns the result of every document and the error of the job (None if it is printed)
+    """
+    printer_uri = get_printer_uri(printer_address)
+    results = [{'filename': pdf_filename, 'state': 'not sent', 'error': None} for _, pdf_filename in documents]
+    job_id = None
+    try:
+        with metrics.timed('printrest_phase_seconds', 'ipp_create_job'):
+            resp = IPPPrinter.create_job(printer_uri, ipp_job_attributes(duplex, page_range, orientation, copies),
+                                         job_name=documents[0][1])
+        resp.raise_for_status()
+        job_id = resp.job_id
+        for i, ((pdf, pdf_filename), result) in enumerate(zip(documents, results)):
+            try:
+                with metrics.timed('printrest_phase_seconds', 'ipp_send_document'):
+                    resp = IPPPrinter.send_document(printer_uri, job_id, pdf, last_document=i == len(documents) - 1,
+                                                    document_name=pdf_filename)
+                resp.raise_for_status()
+            except (IPPError, RequestException) as e:
+                result['state'], result['error'] = 'failed', str(e)
+                raise
+            result['state'] = 'sent'
+    except (IPPError, RequestException) as e:
+        cancel_ipp_job(printer_uri, job_id)
+        return results, ('Printing error: {0}'.format(e), 500)
+    return results, None
+
+
+def progressive_pages(pdf, page_range):
+    """
+    (PdfReader, indexes of the requested pages) if the PDF file has more pages to print than PROGRESSIVE_CHUNK_PAGES,
+    None if it is to be sent as one document (also if it can not be read, the printer tells what is wrong with it).
+    The reader reads the file object only as far as the pages used
+    """
+    try:
+        from pypdf import PdfReader  # Optional, imported when the first long document is printed
+    except ImportError:
+        return None
+    try:
+        reader = PdfReader(pdf)
+        count = 0 if reader.is_encrypted else len(reader.pages)
+    except Exception:  # pypdf raises more than PyPdfError for broken files (KeyError, AttributeError...)
+        count = 0
+
+    if len(page_range) > 0:
+        pages = [index for first, last in IPPPrinter.page_ranges(page_range)
+                 for index in range(max(first, 1) - 1, min(last, count))]
+    else:
+        pages = list(range(count))
+    if len(pages) <= PROGRESSIVE_CHUNK_PAGES:
+        pdf.seek(0)
+        return None
+    return reader, pages
+
+
+def pdf_part(reader, pages):
+    # A new PDF of the given pages (indexes) of the reader
+    from pypdf import PdfWriter
+    writer = PdfWriter()
+    for index in pages:
+        writer.add_page(reader.pages[index])
+    out = BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+def print_ipp_progressive(printer_uri, duplex, orientation, copies, pdf_filename, reader, pages):
+    """
+    The pages as one job of parts of PROGRESSIVE_CHUNK_PAGES pages (an even number for duplex, so no sheet is split),
+    each part is extracted just before it is sent. The requested pages are extracted here, so no page-ranges is sent.
+    A part refused with a server error status (e.g. server-error-busy) was not accepted by the printer, it is sent
+    again up to PROGRESSIVE_RETRIES times, so the job resumes from the last acknowledged part. Otherwise the job is
+    cancelled: if a part can not be extracted, is refused for good or a connection error happens. A part is not sent
+    again after a connection error, the printer may have received it already and would print its pages twice
+    """
+    size = PROGRESSIVE_CHUNK_PAGES + PROGRESSIVE_CHUNK_PAGES % 2 * (duplex != 'none')
+    parts = [pages[i:i + size] for i in range(0, len(pages), size)]
+    job_attributes = ipp_job_attributes(duplex, '', orientation, copies)
+    job_attributes.append(('keyword', 'multiple-document-handling', 'single-document'))
+    job_id = None
+    sent = 0
+    try:
+        with metrics.timed('printrest_phase_seconds', 'ipp_create_job'):
+            resp = IPPPrinter.create_job(printer_uri, job_attributes, job_name=pdf_filename)
+        resp.raise_for_status()
+        job_id = resp.job_id
+        for part_pages in parts:
+            try:
+                with metrics.timed('printrest_phase_seconds', 'split'):
+                    document = pdf_part(reader, part_pages)
+            except Exception as e:  # Any pypdf error, the file was readable when the pages were counted
+                cancel_ipp_job(printer_uri, job_id)
+                return 'The PDF file can not be split after {0} of {1} parts: {2}'.format(sent, len(parts), e), 500
+            for attempt in itertools.count():
+                with metrics.timed('printrest_phase_seconds', 'ipp_send_document'):
+                    resp = IPPPrinter.send_document(printer_uri, job_id, document,
+                                                    last_document=sent == len(parts) - 1,
+                                                    document_name='{0} ({1}/{2})'.format(pdf_filename, sent + 1,
+                                                                                         len(parts)))
+                if resp.ok or resp.status_code not in PROGRESSIVE_RETRY_STATUSES or attempt >= PROGRESSIVE_RETRIES:
+                    break
+                metrics.inc('printrest_progressive_retries_total', status=resp.status)
+                time.sleep(min(2 ** attempt, 10))
+            resp.raise_for_status()
+            sent += 1
+    except (IPPError, RequestException) as e:
+        cancel_ipp_job(printer_uri, job_id)
+        return 'Printing error after {0} of {1} parts: {2}'.format(sent, len(parts), e), 500
+    return None
+
+
+def ipp_job_attributes(duplex, page_range, orientation, copies):
+    job_attributes = [('integer', 'copies', copies), ('keyword', 'sides', IPP_DUPLEX_OPTIONS[duplex]),
+                      ('enum', 'orientation-requested', int(IPP_ORIENTATION[orientation]))]
+    if len(page_range) > 0:
+        job_attributes.append(('rangeOfInteger', 'page-ranges', IPPPrinter.page_ranges(page_range)))
+    return job_attributes
+
 
+def cancel_ipp_job(printer_uri, job_id):
+    # Best effort, nothing to do if the job was not created
+    if job_id is not None:
+        try:
+            IPPPrinter.cancel_job(printer_uri, job_id)
+        except RequestException:
+            pass
+
+
+def print_ipptool(printer_uri, duplex, page_range, orientation, copies, pdf_paths):
     page_ranges = ''
     if len(page_range) > 0:
         page_ranges = 'ATTR rangeOfInteger page-ranges {0}'.format(page_range)
 
-    pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], pdf_filename)
     print_job_config = """{{
     # Copied from: https://raw.githubusercontent.com/istopwg/ippsample/master/examples/create-job.test
     NAME "Create a job with REST API"
@@ -150,7 +444,7 @@ def print_ipp(printer_address, duplex, page_range, orientation, copies, pdf, pdf
         ATTR integer copies {0}
         ATTR keyword sides {1}
         {2}
-        ATTR enum orientation-requested {4}
+        ATTR enum orientation-requested {3}
 
     STATUS successful-ok
 
@@ -158,7 +452,11 @@ def print_ipp(printer_address, duplex, page_range, orientation, copies, pdf, pdf
     EXPECT job-uri
 
 }}
+""".format(copies, IPP_DUPLEX_OPTIONS[duplex], page_ranges, IPP_ORIENTATION[orientation])
 
+    # One Send-Document for each file, the job is complete with the last one
+    for i, pdf_path in enumerate(pdf_paths):
+        print_job_config += """
 {{
 
     NAME "Print a PDF with REST API"
@@ -171,69 +469,720 @@ def print_ipp(printer_address, duplex, page_range, orientation, copies, pdf, pdf
         ATTR uri printer-uri $uri
         ATTR integer job-id $job-id
         ATTR name requesting-user-name $user
-        ATTR boolean last-document true
+        ATTR boolean last-document {1}
 
-    FILE {3}
+    FILE {0}
 
 
     # What statuses are OK?
     STATUS successful-ok
 
 }}
-""".format(copies, DUPLEX_OPTIONS[duplex], page_ranges, pdf_path, ORIENTATION[orientation])
-
-    config_file = os.path.join(app.config['UPLOAD_FOLDER'], '{0}.config'.format(pdf_filename))
-    fh = open(config_file, 'w', encoding='UTF-8')
-    fh.write(print_job_config)
-    fh.close()
-    pdf.save(pdf_path)
-    ret = subprocess.run(['/usr/bin/ipptool', printer_uri, config_file, '-f', pdf_path], stderr=subprocess.PIPE)
-    os.remove(pdf_path)
-    os.remove(config_file)
+""".format(pdf_path, 'true' if i == len(pdf_paths) - 1 else 'false')
+
+    with tempfile.NamedTemporaryFile('w', encoding='UTF-8', dir=UPLOAD_FOLDER, suffix='.test') as fh:
+        fh.write(print_job_config)
+        fh.flush()
+        with metrics.timed('printrest_phase_seconds', 'ipptool'):
+            ret = subprocess.run(['/usr/bin/ipptool', printer_uri, fh.name, '-f', pdf_paths[0]], stderr=subprocess.PIPE)
     if ret.returncode != 0:
         err_msg = ret.stderr.decode('UTF-8').rstrip()
         return 'Printing error: {0}'.format(err_msg), 500
     return None
 
 
+def printer_busy(state):
+    return state is not None and state['state'] == 'processing'
+
+
+def get_printers():
+    with printers_lock:
+        if len(printers) == 0:
+            for name, address in (PRINTERS or {PRINTER: PRINTER}).items():
+                printers[name] = {'name': name, 'address': address, 'lock': threading.Lock(), 'queue': queue.Queue(),
+                                  'workers': [], 'load': 0, 'state': 'unknown', 'state_reasons': [],
+                                  'queued_job_count': 0, 'probed_at': None}
+                printers[name]['poller'] = StatePoller(name, partial(query_printer_state, printers[name]),
+                                                       POLL_INTERVALS, busy=printer_busy)
+                if PRINTER_POLLING:
+                    printers[name]['poller'].start()
+        return printers
+
+
+def query_printer_state(printer):
+    """
+    Cheap state query: printer-state, printer-state-reasons and queued-job-count over IPP, lpstat for lp printers.
+    The result (or 'unknown' if the query fails) is also kept in the printer for dispatching
+    """
+    state = {'state': 'unknown', 'state_reasons': [], 'queued_job_count': 0}
+    try:
+        if BACKEND == 'lp':
+            out = subprocess.run(['lpstat', '-p', printer['address']], stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL, timeout=sum(PRINTER_PROBE_TIMEOUT)).stdout.decode('UTF-8')
+            if 'disabled' in out:
+                state['state'] = 'stopped'
+            elif 'idle' in out:
+                state['state'] = 'idle'
+            elif 'printing' in out:
+                state['state'] = 'processing'
+        else:
+            resp = IPPPrinter.get_printer_attributes(get_printer_uri(printer['address']),
+                                                     ['printer-state', 'printer-state-reasons', 'queued-job-count'],
+                                                     timeout=PRINTER_PROBE_TIMEOUT)
+            state['state'] = IPPPrinter.printer_states.get(resp.get('printer', 'printer-state'), 'unknown')
+            state['state_reasons'] = resp.group('printer').get('printer-state-reasons', [])
+            state['queued_job_count'] = resp.get('printer', 'queued-job-count', 0)
+    finally:
+        with printers_lock:
+            printer['state'] = state['state']
+            printer['state_reasons'] = state['state_reasons']
+            printer['queued_job_count'] = state['queued_job_count']
+            printer['probed_at'] = time.monotonic()
+    return state
+
+
+def probe_printer(printer):
+    # The state kept by the poller is used as it is, otherwise it is queried again after PRINTER_STATE_TTL
+    if PRINTER_POLLING or \
+            printer['probed_at'] is not None and time.monotonic() < printer['probed_at'] + PRINTER_STATE_TTL:
+        return
+    try:
+        query_printer_state(printer)
+    except (OSError, subprocess.SubprocessError, RequestException):
+        pass
+
+
+def printer_candidates(target=''):
+    # target is a printer name (pinned), a printer class or '' for any printer, None if there is no such target
+    pool = get_printers()
+    if target in pool:
+        return [pool[target]]
+    elif target in PRINTER_CLASSES:
+        return [pool[name] for name in PRINTER_CLASSES[target]]
+    elif target == '':
+        return list(pool.values())
+    return None
+
+
+def admission_problem(printer):
+    """
+    Why the printer should not get a new job according to its last known state and its ADMISSION settings,
+    None if it can get one
+    """
+    settings = dict(ADMISSION, **PRINTER_ADMISSION.get(printer['name'], {}))
+    probe_printer(printer)
+    if printer['state'] == 'stopped' and settings['reject_stopped']:
+        return 'stopped'
+    reasons = {re.sub('-(error|warning|report)$', '', reason) for reason in printer['state_reasons']}
+    rejected = reasons & set(settings['reject_reasons'])
+    if len(rejected) > 0:
+        return ', '.join(sorted(rejected))
+    queued = printer['queued_job_count'] + printer['load']
+    if queued >= settings['max_queued_jobs']:
+        return '{0} jobs queued'.format(queued)
+    return None
+
+
+def rejection(problems):
+    # The 503 response with Retry-After for a job which none of the printers (name -> admission problem) can take
+    retry_after = min(dict(ADMISSION, **PRINTER_ADMISSION.get(name, {}))['retry_after'] for name in problems)
+    return jsonify(error='No printer can take the job now', printers=problems, retry_after=retry_after), 503, \
+        {'Retry-After': str(retry_after)}
+
+
+def choose_printer(target=''):
+    """
+    The least loaded printer is chosen: jobs sent by us and not finished yet, then idle printers first,
+    then the jobs queued on the printer. Printers which are not admitted (e.g. stopped) are only chosen
+    if all candidates are like that. The job must be reported finished with release_printer()
+    """
+    candidates = printer_candidates(target)
+    if candidates is None:
+        return None
+
+    admitted = [printer for printer in candidates if admission_problem(printer) is None]
+    with printers_lock:
+        available = admitted or [printer for printer in candidates if printer['state'] != 'stopped'] or candidates
+        chosen = min(available, key=lambda p: (p['load'], p['state'] != 'idle', p['queued_job_count']))
+        chosen['load'] += 1
+    return chosen
+
+
+def requested_printer():
+    # The query string is read before the upload, the form field after it
+    return request.args.get('printer') or request.form.get('printer', '')
+
+
+def release_printer(printer):
+    with printers_lock:
+        printer['load'] -= 1
+
+
+def print_file(printer, duplex, page_range, orientation, copies, pdf, pdf_filename):
+    # Only one job is sent to a printer at a time, jobs to other printers of the pool go in parallel
+    start = time.perf_counter()
+    with printer['lock']:
+        lock_wait = time.perf_counter() - start
+        metrics.observe('printrest_lock_wait_seconds', lock_wait, printer=printer['name'])
+        metrics.add_timing('lock_wait', lock_wait)
+        try:
+            if BACKEND == 'lp':
+                return print_lp(printer['address'], duplex, page_range, orientation, copies, pdf, pdf_filename)
+            else:
+                return print_ipp(printer['address'], duplex, page_range, orientation, copies, pdf, pdf_filename)
+        finally:
+            printer['poller'].poke()  # The printer is busy with the job now
+
+
+def print_files(printer, duplex, page_range, orientation, copies, documents):
+    """
+    Several (pdf, pdf_filename) documents as one job. Returns the result of every document
+    and the error of the job (None if it is printed)
+    """
+    start = time.perf_counter()
+    with printer['lock']:
+        lock_wait = time.perf_counter() - start
+        metrics.observe('printrest_lock_wait_seconds', lock_wait, printer=printer['name'])
+        metrics.add_timing('lock_wait', lock_wait)
+        try:
+            if BACKEND != 'lp' and IPP_BACKEND == 'native':
+                return print_ipp_batch(printer['address'], duplex, page_range, orientation, copies, documents)
+
+            # lp and ipptool read the documents from files, the temporary ones are removed even if printing fails
+            with ExitStack() as stack:
+                pdf_paths = []
+                for pdf, pdf_filename in documents:
+                    pdf_path = document_path(pdf)
+                    if pdf_path is None:
+                        fh = stack.enter_context(tempfile.NamedTemporaryFile(dir=UPLOAD_FOLDER,
+                                                                             suffix='_{0}'.format(pdf_filename)))
+                        with metrics.timed('printrest_phase_seconds', 'save'):
+                            shutil.copyfileobj(pdf, fh, CHUNK_SIZE)
+                            fh.flush()
+                        pdf_path = fh.name
+                    pdf_paths.append(pdf_path)
+                if BACKEND == 'lp':
+                    ret = print_lp_files(printer['address'], duplex, page_range, orientation, copies, pdf_paths,
+                                         documents[0][1])
+                else:
+                    ret = print_ipptool(get_printer_uri(printer['address']), duplex, page_range, orientation, copies,
+                                        pdf_paths)
+            return [{'filename': pdf_filename, 'state': 'sent' if ret is None else 'failed',
+                     'error': None if ret is None else ret[0]} for _, pdf_filename in documents], ret
+        finally:
+            printer['poller'].poke()  # The printer is busy with the job now
+
+
+def print_worker(printer):
+    while True:
+        job_id, (duplex, page_range, orientation, copies, pdf_path) = printer['queue'].get()
+        with print_jobs_lock:
+            job = print_jobs[job_id]
+            job['state'] = 'sending'
+            job['started_at'] = time.time()
+        metrics.observe('printrest_phase_seconds', job['started_at'] - job['queued_at'], phase='queue_wait')
+        try:
+            with open(pdf_path, 'rb') as pdf:
+                ret = print_file(printer, duplex, page_range, orientation, copies, pdf, job['filename'])
+        except Exception as e:  # The worker must survive any failure
+            ret = 'Printing error: {0}'.format(e), 500
+        finally:
+            release_printer(printer)
+            try:
+                os.remove(pdf_path)
+            except OSError:  # Already gone (e.g. removed by a /tmp cleaner)
+                pass
+        with print_jobs_lock:
+            job['finished_at'] = time.time()
+            if ret is None:
+                job['state'] = 'done'
+            else:
+                job['state'] = 'failed'
+                job['error'] = ret[0]
+        metrics.inc('printrest_jobs_total', state=job['state'], printer=printer['name'])
+        printer['queue'].task_done()
+
+
+def enqueue_print_job(printer, job_id, pdf_filename, duplex, page_range, orientation, copies, pdf_path):
+    now = time.time()
+    with print_jobs_lock:
+        for old_job_id in [k for k, v in print_jobs.items()
+                           if v['finished_at'] is not None and v['finished_at'] + JOB_RETENTION < now]:
+            del print_jobs[old_job_id]
+        print_jobs[job_id] = {'id': job_id, 'filename': pdf_filename, 'printer': printer['name'], 'state': 'queued',
+                              'error': None, 'queued_at': now, 'started_at': None, 'finished_at': None}
+        workers = printer['workers']
+        while len(workers) < PRINT_WORKERS:
+            worker = threading.Thread(target=print_worker, args=(printer,), daemon=True,
+                                      name='print-worker-{0}-{1}'.format(printer['name'], len(workers)))
+            worker.start()
+            workers.append(worker)
+    printer['queue'].put((job_id, (duplex, page_range, orientation, copies, pdf_path)))
+
+
+def print_or_enqueue(printer, job_id, pdf_filename, options, save, open_pdf, finished):
+    """
+    The response of a print request for the chosen printer. In the queued mode save(path) puts the document where
+    the job reads it and the job id is answered (202), otherwise the document of open_pdf() (a context manager)
+    is printed before answering. finished(ok) is called when the job is printed or failed, in the queued mode only
+    if the document could not be saved. The printer is released when it is not needed anymore
+    """
+    duplex, page_range, orientation, copies = options
+    if QUEUED:
+        pdf_path = os.path.join(UPLOAD_FOLDER, '{0}_{1}'.format(job_id, pdf_filename))
+        try:
+            with metrics.timed('printrest_phase_seconds', 'save'):
+                save(pdf_path)
+        except OSError:
+            release_printer(printer)
+            finished(False)
+            raise
+        enqueue_print_job(printer, job_id, pdf_filename, duplex, page_range, orientation, copies, pdf_path)
+        status_url = url_for('.job', job_id=job_id)
+        return jsonify(id=job_id, state='queued', printer=printer['name'], status_url=status_url), 202, \
+            {'Location': status_url}
+
+    ret = 'Printing error: interrupted', 500
+    try:
+        with open_pdf() as pdf:
+            ret = print_file(printer, duplex, page_range, orientation, copies, pdf, pdf_filename)
+    finally:
+        release_printer(printer)
+        finished(ret is None)
+    metrics.inc('printrest_jobs_total', state='done' if ret is None else 'failed', printer=printer['name'])
+    if ret is not None:
+        return ret
+    return 'Printing "{0}" to "{1}" with duplex "{2}" range "{3}" in "{4}" orientation {5} times...'.format(
+        pdf_filename, printer['name'], duplex, page_range, orientation, copies)
+
+
+def backend_options():
+    # (duplex options, orientations) of BACKEND, looked up when used, so BACKEND can come from the config
+    if BACKEND == 'lp':
+        return LP_DUPLEX_OPTIONS, LP_ORIENTATION
+    return IPP_DUPLEX_OPTIONS, IPP_ORIENTATION
+
+
+def parse_print_options(form):
+    """
+    (duplex, page_range, orientation, copies) from the form, None if any of them is wrong
+    """
+    duplex = form.get('duplex', '')
+    page_range = form.get('range', '')
+    orientation = form.get('orientation', '')
+    copies = form.get('copies', '')
+    if copies == '':
+        copies = 1
+    elif copies.isdigit():
+        copies = int(copies)
+    else:
+        return None
+
+    duplex_options, orientations = backend_options()
+    if duplex in duplex_options and \
+            (len(page_range) == 0 or RANGE_RE.match(page_range)) and \
+            orientation in orientations and \
+            copies > 0:
+        return duplex, page_range, orientation, copies
+    return None
+
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1] in ALLOWED_EXTENSIONS
+
+
+def submission_key(digest, values, printer):
+    copies = values.get('copies', '')
+    return (digest, values.get('duplex', ''), values.get('range', ''), values.get('orientation', ''),
+            int(copies) if copies.isdigit() else 1, printer)
+
+
+def _find_submission(key, now):
+    # Must be called with submissions_lock held, failed jobs do not count as submitted
+    for old_key in [k for k, v in submissions.items() if v['expires'] < now]:
+        del submissions[old_key]
+    submission = submissions.get(key)
+    if submission is not None and submission['job_id'] is not None:
+        with print_jobs_lock:
+            job = print_jobs.get(submission['job_id'])
+            if job is None or job['state'] == 'failed':
+                return None
+            submission = dict(submission, state=job['state'], job=job_status(job))
+    return submission
+
+
+def find_submission(key):
+    with submissions_lock:
+        return _find_submission(key, time.monotonic())
+
+
+def claim_submission(key, job_id, pdf_filename):
+    """
+    Returns the earlier submission of the same document with the same options within DEDUP_WINDOW,
+    or registers this one and returns None
+    """
+    if DEDUP_WINDOW <= 0:
+        return None
+    now = time.monotonic()
+    with submissions_lock:
+        submission = _find_submission(key, now)
+        if submission is not None:
+            return submission
+        submissions[key] = {'job_id': job_id, 'filename': pdf_filename, 'state': 'sending',
+                            'expires': now + DEDUP_WINDOW}
+    return None
+
+
+def finish_submission(key, succeeded):
+    # The window starts again when the document is printed, failed submissions can be retried at once
+    with submissions_lock:
+        if not succeeded:
+            submissions.pop(key, None)
+        elif key in submissions:
+            submissions[key]['state'] = 'done'
+            submissions[key]['expires'] = time.monotonic() + DEDUP_WINDOW
+
+
+def upload_paths(upload_id):
+    # The uploaded bytes and the session (file name, expected length), on disk to be seen by every worker process
+    base = os.path.join(UPLOAD_FOLDER, 'upload_{0}'.format(upload_id))
+    return '{0}.part'.format(base), '{0}.json'.format(base)
+
+
+def create_upload(pdf_filename, length):
+    now = time.time()
+    for name in os.listdir(UPLOAD_FOLDER):
+        if name.startswith('upload_') and (name.endswith('.part') or name.endswith('.json')):
+            path = os.path.join(UPLOAD_FOLDER, name)
+            try:
+                if os.path.getmtime(path) + UPLOAD_SESSION_TTL < now:
+                    os.remove(path)
+            except OSError:
+                pass
+    upload_id = uuid.uuid4().hex
+    part_path, session_path = upload_paths(upload_id)
+    open(part_path, 'wb').close()
+    with open(session_path, 'w', encoding='UTF-8') as fh:
+        json.dump({'filename': pdf_filename, 'length': length}, fh)
+    return upload_id
+
+
+def get_upload(upload_id):
+    """
+    The session with the committed offset (the bytes on disk) or None if there is no such upload
+    """
+    if UPLOAD_ID_RE.match(upload_id) is None:
+        return None
+    part_path, session_path = upload_paths(upload_id)
+    try:
+        with open(session_path, encoding='UTF-8') as fh:
+            session = json.load(fh)
+        session['offset'] = os.path.getsize(part_path)
+    except (OSError, ValueError):
+        return None
+    session['id'] = upload_id
+    return session
+
+
+def write_upload(upload_id, offset, size, stream):
+    """
+    Appends at most size bytes of the stream at offset, which must be the committed offset. Every byte that arrives
+    is kept, so an interrupted chunk is resumed from where it broke. False if the upload is busy or at another offset
+    """
+    part_path, session_path = upload_paths(upload_id)
+    with open(part_path, 'ab') as fh:
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)  # One writer at a time in all processes
+        except BlockingIOError:
+            return False
+        # The size at open() may be stale, another request may have appended to it before the lock was taken
+        if os.fstat(fh.fileno()).st_size != offset:
+            return False
+        try:
+            chunk = stream.read(min(CHUNK_SIZE, size))
+            while len(chunk) > 0:
+                fh.write(chunk)
+                size -= len(chunk)
+                chunk = stream.read(min(CHUNK_SIZE, size))
+        except ClientDisconnected:
+            pass
+    os.utime(session_path)
+    return True
+
+
+def remove_upload(upload_id):
+    for path in upload_paths(upload_id):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def upload_response(session, code=200):
+    resp = jsonify(id=session['id'], filename=session['filename'], offset=session['offset'], length=session['length'],
+                   complete=session['offset'] == session['length'], url=url_for('.upload', upload_id=session['id']))
+    resp.status_code = code
+    resp.headers['Upload-Offset'] = str(session['offset'])
+    if session['offset'] > 0:
+        resp.headers['Range'] = 'bytes=0-{0}'.format(session['offset'] - 1)
+    return resp
+
+
+def job_status(job):
+    status = dict(job)
+    now = time.time()
+    started_at = job['started_at'] or now
+    status['wait_seconds'] = round(started_at - job['queued_at'], 3)
+    if job['started_at'] is not None:
+        status['send_seconds'] = round((job['finished_at'] or now) - job['started_at'], 3)
+    return status
+
+
 class PrintREST(Resource):
     @staticmethod
-    @app.route('/print')
+    @blueprint.before_request
+    def admit():
+        """
+        New jobs are refused before their upload is read, if no printer they may go to can take them now.
+        The target printer or class must be in the query string (?printer=...) to be considered here
+        """
+        if request.method != 'POST' or request.endpoint not in \
+                {'printrest.print', 'printrest.batch', 'printrest.new_upload', 'printrest.print_upload'}:
+            return None
+        candidates = printer_candidates(request.args.get('printer', ''))
+        if candidates is None:
+            return None  # Reported by the view
+        problems = {printer['name']: admission_problem(printer) for printer in candidates}
+        if any(problem is None for problem in problems.values()):
+            return None
+        metrics.inc('printrest_rejected_total', endpoint=request.endpoint)
+        return rejection(problems)
+
+    @staticmethod
+    @blueprint.route('/print')
     def usage():
-        return print_upload_form
+        return page_response(pages.get('print', None, PrintREST._render_form))
 
     @staticmethod
-    @app.route('/print', methods=['POST'])
+    def _render_form():
+        options = ['<option value="">Any</option>']
+        options.extend('<option value="{0}">{0}</option>'.format(name)
+                       for name in list(PRINTER_CLASSES.keys()) + list(get_printers().keys()))
+        return print_upload_form.replace('PRINTER_OPTIONS_PLACEHOLDER', '\n'.join(options))
+
+    @staticmethod
+    @blueprint.route('/print', methods=['POST'])
     def print():
-        pdf = request.files['uploadedPDF']
+        # Accessing the files reads and parses the whole request body
+        with metrics.timed('printrest_phase_seconds', 'upload'):
+            pdf = request.files['uploadedPDF']
         pdf_filename = secure_filename(pdf.filename)
 
-        duplex = request.form['duplex']
-        page_range = request.form['range']
-        orientation = request.form['orientation']
-        copies = request.form['copies']
-        if copies == '':
-            copies = 1
-        else:
-            copies = int(copies)
-
-        if duplex in DUPLEX_OPTIONS and \
-                pdf and pdf.filename.rsplit('.', 1)[1] in ALLOWED_EXTENSIONS and \
-                (len(page_range) == 0 or RANGE_RE.match(page_range)) and \
-                orientation in ORIENTATION and \
-                copies > 0:
-            with print_lock:
-                if lp:
-                    ret = print_lp(duplex, page_range, orientation, copies, pdf, pdf_filename)
-                else:
-                    ret = print_ipp(PRINTER, duplex, page_range, orientation, copies, pdf, pdf_filename)
-            if ret is not None:
-                return ret
+        options = parse_print_options(request.form)
+        if options is not None and pdf and allowed_file(pdf.filename):
+            job_id = uuid.uuid4().hex
+            key = submission_key(pdf.stream.sha256.hexdigest(), request.form, requested_printer())
+            submission = claim_submission(key, job_id if QUEUED else None, pdf_filename)
+            if submission is not None:
+                metrics.inc('printrest_duplicates_total')
+                return PrintREST._duplicate(submission)
+
+            printer = choose_printer(requested_printer())
+            if printer is None:
+                finish_submission(key, False)
+                return 'No such printer or printer class: {0}'.format(requested_printer()), 400
+
+            # The queued jobs outlive the request, so the upload is kept on disk until it is printed
+            return print_or_enqueue(printer, job_id, pdf_filename, options, pdf.save, partial(nullcontext, pdf.stream),
+                                    partial(finish_submission, key))
+        return 'Some parameters wrong: {0} {1}'.format(request.form.get('duplex'), pdf.filename), 400
+
+    @staticmethod
+    @blueprint.route('/print/batch', methods=['POST'])
+    def batch():
+        """
+        Every uploadedPDF file of the request is printed as one job with the options of /print,
+        the result of each document is reported
+        """
+        with metrics.timed('printrest_phase_seconds', 'upload'):
+            pdfs = request.files.getlist('uploadedPDF')
+        options = parse_print_options(request.form)
+        if options is None or len(pdfs) == 0 or not all(pdf and allowed_file(pdf.filename) for pdf in pdfs):
+            return jsonify(error='Some parameters wrong', filenames=[pdf.filename for pdf in pdfs]), 400
+        duplex, page_range, orientation, copies = options
+
+        printer = choose_printer(requested_printer())
+        if printer is None:
+            return jsonify(error='No such printer or printer class: {0}'.format(requested_printer())), 400
+        results, ret = [], ('Printing error: interrupted', 500)
+        try:
+            results, ret = print_files(printer, duplex, page_range, orientation, copies,
+                                       [(pdf.stream, secure_filename(pdf.filename)) for pdf in pdfs])
+        finally:
+            release_printer(printer)
+            metrics.inc('printrest_jobs_total', state='done' if ret is None else 'failed', printer=printer['name'])
+        return jsonify(printer=printer['name'], state='done' if ret is None else 'failed',
+                       error=None if ret is None else ret[0], documents=results), 200 if ret is None else ret[1]
+
+    @staticmethod
+    def _duplicate(submission):
+        if 'job' in submission:
+            status_url = url_for('.job', job_id=submission['job_id'])
+            return jsonify(dict(submission['job'], duplicate=True, status_url=status_url)), 200, \
+                {'Location': status_url}
+        return 'Already printing "{0}", the duplicate submission is ignored.'.format(submission['filename'])
+
+    @staticmethod
+    @blueprint.route('/print/uploads', methods=['POST'])
+    def new_upload():
+        """
+        Starts a resumable upload: the chunks are PUT to the returned URL with Content-Range, the committed offset
+        is at GET (or HEAD) of the URL, and POST to <url>/print prints the document with the fields of /print
+        """
+        pdf_filename = secure_filename(request.values.get('filename', ''))
+        length = request.values.get('length', '')
+        length = int(length) if length.isdigit() else None
+        if not allowed_file(pdf_filename) or length is not None and length > UPLOAD_MAX_LENGTH:
+            return jsonify(error='A PDF file name (and the length up to {0} bytes) is needed'.
+                           format(UPLOAD_MAX_LENGTH)), 400
+        upload_id = create_upload(pdf_filename, length)
+        resp = upload_response(get_upload(upload_id), 201)
+        resp.headers['Location'] = url_for('.upload', upload_id=upload_id)
+        return resp
+
+    @staticmethod
+    @blueprint.route('/print/uploads/<upload_id>')
+    def upload(upload_id):
+        session = get_upload(upload_id)
+        if session is None:
+            return jsonify(error='No such upload: {0}'.format(upload_id)), 404
+        return upload_response(session)
+
+    @staticmethod
+    @blueprint.route('/print/uploads/<upload_id>', methods=['PUT'])
+    def upload_chunk(upload_id):
+        session = get_upload(upload_id)
+        if session is None:
+            return jsonify(error='No such upload: {0}'.format(upload_id)), 404
+        match = CONTENT_RANGE_RE.match(request.headers.get('Content-Range', ''))
+        if match is None:
+            return jsonify(error='Content-Range: bytes <first>-<last>/<length or *> is needed'), 400
+        first, last = int(match.group(1)), int(match.group(2))
+        length = session['length'] if match.group(3) == '*' else int(match.group(3))
+        if last < first or last >= (length if length is not None else UPLOAD_MAX_LENGTH) or \
+                length is not None and (length > UPLOAD_MAX_LENGTH or session['length'] not in {None, length}):
+            return jsonify(error='Invalid Content-Range: {0}'.format(request.headers['Content-Range'])), 416
+        if session['length'] is None and length is not None:
+            session['length'] = length
+            with open(upload_paths(upload_id)[1], 'w', encoding='UTF-8') as fh:
+                json.dump({'filename': session['filename'], 'length': length}, fh)
+
+        with metrics.timed('printrest_phase_seconds', 'upload_chunk'):
+            written = write_upload(upload_id, first, last - first + 1, request.stream)
+        session = get_upload(upload_id)
+        if session is None:
+            return jsonify(error='No such upload: {0}'.format(upload_id)), 404
+        # 409 tells the client to continue from the committed offset
+        return upload_response(session, 200 if written else 409)
+
+    @staticmethod
+    @blueprint.route('/print/uploads/<upload_id>', methods=['DELETE'])
+    def delete_upload(upload_id):
+        if get_upload(upload_id) is None:
+            return jsonify(error='No such upload: {0}'.format(upload_id)), 404
+        remove_upload(upload_id)
+        return jsonify(id=upload_id, deleted=True)
+
+    @staticmethod
+    @blueprint.route('/print/uploads/<upload_id>/print', methods=['POST'])
+    def print_upload(upload_id):
+        session = get_upload(upload_id)
+        if session is None:
+            return jsonify(error='No such upload: {0}'.format(upload_id)), 404
+        if session['length'] is not None and session['offset'] != session['length'] or session['offset'] == 0:
+            return upload_response(session, 409)
+        options = parse_print_options(request.form)
+        if options is None:
+            return jsonify(error='Some parameters wrong'), 400
+
+        printer = choose_printer(requested_printer())
+        if printer is None:
+            return jsonify(error='No such printer or printer class: {0}'.format(requested_printer())), 400
+        part_path = upload_paths(upload_id)[0]
+
+        def take_over(pdf_path):
+            # The queued job takes over the uploaded file and removes it when it is printed
+            os.replace(part_path, pdf_path)
+            remove_upload(upload_id)
+
+        def finished(ok):
+            if ok:
+                remove_upload(upload_id)  # A failed job can be printed again without uploading it again
+
+        return print_or_enqueue(printer, uuid.uuid4().hex, session['filename'], options, take_over,
+                                partial(open, part_path, 'rb'), finished)
+
+    @staticmethod
+    @blueprint.route('/print/submitted/<digest>')
+    def submitted(digest):
+        """
+        Lets clients check with the SHA-256 of a document (and the print options as query parameters)
+        whether the upload can be skipped, because it was submitted within DEDUP_WINDOW
+        """
+        submission = find_submission(submission_key(digest.lower(), request.args, request.args.get('printer', '')))
+        if submission is None:
+            return jsonify(submitted=False), 404
+        return jsonify(submitted=True, filename=submission['filename'], state=submission['state'],
+                       job=submission.get('job'))
+
+    @staticmethod
+    @blueprint.route('/print/state')
+    def state():
+        # Served from the background pollers, ?since=<version>&wait=<seconds> waits for the next change
+        return state_response([printer['poller'] for printer in get_printers().values()])
+
+    @staticmethod
+    @blueprint.route('/print/events')
+    def events():
+        # Server-sent events with the state of the printers (idle, processing, stopped and the reasons)
+        return events_response([printer['poller'] for printer in get_printers().values()])
+
+    @staticmethod
+    @blueprint.route('/print/jobs/<job_id>')
+    def job(job_id):
+        with print_jobs_lock:
+            job = print_jobs.get(job_id)
+            if job is None:
+                return 'No such job: {0}'.format(job_id), 404
+            return jsonify(job_status(job))
+
+
+def init_app(app):
+    if BACKEND not in {'ipp', 'lp'}:
+        raise ValueError("BACKEND must be 'ipp' or 'lp' instead of {0!r}".format(BACKEND))
+    app.request_class = HashingRequest
+    app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+    app.register_blueprint(blueprint)
+
+
+def warm_up():
+    """
+    Query the state of every printer (which opens its pooled connection) and render the form, so the first
+    requests after the start do not wait for them. Returns printer name -> error (None if it answered)
+    """
+    errors = {}
+    for name, printer in get_printers().items():
+        try:
+            query_printer_state(printer)
+            errors[name] = None
+        except Exception as e:  # An unreachable printer must not stop the others
+            errors[name] = str(e)
+    pages.get('print', None, PrintREST._render_form)
+    return errors
+
 
-            return 'Printing "{0}" to "{1}" with duplex "{2}" range "{3}" in "{4}" orientation {5} times...'.format(
-                pdf_filename, PRINTER, duplex, page_range, orientation, copies)
-        return 'Some parameters wrong: {0} {1}'.format(duplex, pdf.filename), 400
+__getattr__ = application.lazy_app(__name__)  # from printrest import app
 
 
 if __name__ == '__main__':
-    app.run(debug=False)
+    application.service_app('printrest').run(debug=False)
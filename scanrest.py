@@ -1,19 +1,93 @@
 #!/usr/bin/python3
 # -*- coding: utf-8, vim: expandtab:ts=4 -*-
 
+import os
+import re
+import time
+import uuid
+import fcntl
+import random
+import itertools
 import threading
-from io import BytesIO
+from functools import partial
+from types import MappingProxyType
+from collections import deque
+from zipfile import ZipFile, ZipInfo, ZIP_STORED
 from xml.etree import ElementTree
 from json import dumps
 
-from flask import Flask, request, send_file
-from flask_restful import Resource, Api
+from flask import Blueprint, Response, request, jsonify, stream_with_context, send_file, url_for
+from flask_restful import Resource
+from werkzeug.wsgi import ClosingIterator
 
-from requests import get as requests_get, post as requests_post
+from requests import Session, RequestException, Timeout
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+import application
+import postprocess
+from pages import PageCache, page_response
+from poller import StatePoller, state_response, events_response
 
 # To be edited...
 SCANNER_IP = '192.168.X.X'
+SCANNERS = {}  # Scanner registry: name -> scanner ip, only SCANNER_IP is used when it is empty
+SCAN_QUEUE_TIMEOUT = 60  # Seconds a scan request may wait for a busy scanner before it is answered with 429
+SCAN_QUEUE_LENGTH = 5  # Requests allowed to wait for a scanner, further ones are answered with 429 immediately
+# The queues are per process, a lock file per scanner here lets one scan at a time through all the worker processes
+SCAN_LOCK_FOLDER = '/tmp/scanrest_locks/'
 ALLOW_MAX_A4_SIZE = False
+CAPABILITIES_TTL = 3600  # Seconds to reuse the parsed ScannerCapabilities (0 to fetch them on every request)
+SCAN_CHUNK_SIZE = 64 * 1024  # Bytes held in memory at once while passing the scanned document to the client
+HTTP_TIMEOUT = (3.05, 60)  # Connect and read timeouts in seconds for the requests sent to the scanner
+HTTP_RETRIES = 3  # Times to retry when the connection to the scanner can not be made or is reset
+HTTP_POOL_SIZE = 4  # Keep-alive connections kept open to each scanner
+NEXT_DOCUMENT_DEADLINE = 300  # Seconds to wait for the scanner to start sending a page (busy answers are retried)
+NEXT_DOCUMENT_BACKOFF = (0.5, 8)  # First and longest wait in seconds between two NextDocument attempts (with jitter)
+RESULTS_FOLDER = '/tmp/scanrest_results/'  # Scanned documents are kept here to be downloaded again
+RESULTS_MAX_AGE = 24 * 3600  # Seconds to keep a scanned document (0 to not keep them at all)
+RESULTS_MAX_BYTES = 1024 * 1024 * 1024  # The oldest documents are deleted when the kept ones take more space
+SCANNER_POLLING = True  # Keep the state of every scanner up to date in the background (GET /scan/state, /scan/events)
+POLL_INTERVALS = (1, 30)  # Shortest and longest seconds between two ScannerStatus queries, the longest while idle
+
+
+class ScanAborted(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+class Frozen:
+    """
+    Base of the immutable capability objects: the attributes are given to the constructor and never change,
+    so one object can be shared by all requests (and used as a cache key)
+    """
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{0} is immutable'.format(type(self).__name__))
+
+
+class SourceCapabilities(Frozen):
+    """
+    What an input source (Platen or Feeder) can do. limits: resolution -> (min width, max width, min height,
+    max height) in pixels at that resolution
+    """
+    __slots__ = ('name', 'resolutions', 'limits', 'colormodes', 'formats', 'intents', 'max_optical_resolution')
+
+
+class ScannerCapabilities(Frozen):
+    """
+    The capabilities of a scanner, built once per fetch: sources: name -> SourceCapabilities,
+    combinations: the valid (source, color mode, format, intent) tuples, json: the form of the /scan page
+    """
+    __slots__ = ('version', 'make_and_model', 'serial_number', 'sources', 'combinations', 'json')
 
 
 class ESCLScanner:
@@ -49,6 +123,41 @@ class ESCLScanner:
       <scan:Intent>{7}</scan:Intent>
     </scan:ScanSettings>"""
 
+    # scanner_ip -> (expiry time, capabilities)
+    _capabilities_cache = {}
+    _capabilities_cache_lock = threading.Lock()
+
+    # scanner_ip -> (time of the query, (status, version, serial number)) from the last ScannerStatus
+    _status_cache = {}
+
+    # (scanner_ip, retry_reads) -> requests.Session with its own connection pool
+    _sessions = {}
+    _sessions_lock = threading.Lock()
+
+    @staticmethod
+    def session(scanner_ip, retry_reads=True):
+        """
+        POST is not retried once the request could have reached the scanner to avoid duplicate jobs. Without
+        retry_reads a read timeout is not retried for GET either (NextDocument hands out a page with every request),
+        it is raised as requests.Timeout
+        """
+        with ESCLScanner._sessions_lock:
+            session = ESCLScanner._sessions.get((scanner_ip, retry_reads))
+            if session is None:
+                retries = Retry(total=HTTP_RETRIES, connect=HTTP_RETRIES, read=HTTP_RETRIES if retry_reads else False,
+                                status=0, backoff_factor=0.1, raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=retries)
+                session = Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                ESCLScanner._sessions[(scanner_ip, retry_reads)] = session
+            return session
+
+    @staticmethod
+    def _get(scanner_ip, url, **kwargs):
+        kwargs.setdefault('timeout', HTTP_TIMEOUT)
+        return ESCLScanner.session(scanner_ip).get(url, **kwargs)
+
     @staticmethod
     def _get_range(inp_caps, namespaces):
         """
@@ -89,22 +198,91 @@ class ESCLScanner:
         return min(x_max_optical_resolution, y_max_optical_resolution)
 
     @staticmethod
-    def get_capabilities(scanner_ip):
+    def _fetch_status(scanner_ip):
         namespaces = ESCLScanner.namespaces
 
         # .content == .text in bytes
-        scanner_status_xml = requests_get('http://{0}/eSCL/ScannerStatus'.format(scanner_ip)).content
+        scanner_status_xml = ESCLScanner._get(scanner_ip, 'http://{0}/eSCL/ScannerStatus'.format(scanner_ip)).content
         scanner_status_tree = ElementTree.fromstring(scanner_status_xml)
         status = scanner_status_tree.find('./pwg:State', namespaces).text
+        version = scanner_status_tree.find('./pwg:Version', namespaces)
+        serial_number = scanner_status_tree.find('./pwg:SerialNumber', namespaces)
+        adf_state = scanner_status_tree.find('./scan:AdfState', namespaces)
+        ESCLScanner._status_cache[scanner_ip] = \
+            (time.monotonic(), (status, getattr(version, 'text', None), getattr(serial_number, 'text', None)))
+        return {'state': status, 'adf_state': getattr(adf_state, 'text', None)}
+
+    @staticmethod
+    def _get_status(scanner_ip):
+        """
+        ScannerStatus carries the eSCL version (and on some devices the serial number) along with the state,
+        which is enough to tell whether the cached capabilities still belong to the device at this address.
+        The result of the background poller is used while it is fresh
+        """
+        queried_at, status = ESCLScanner._status_cache.get(scanner_ip, (None, None))
+        if not SCANNER_POLLING or queried_at is None or time.monotonic() > queried_at + 2 * POLL_INTERVALS[1]:
+            ESCLScanner._fetch_status(scanner_ip)
+            queried_at, status = ESCLScanner._status_cache[scanner_ip]
+        return status
+
+    @staticmethod
+    def get_status(scanner_ip):
+        return ESCLScanner._get_status(scanner_ip)[0]
+
+    @staticmethod
+    def get_state(scanner_ip):
+        # State and feeder state (e.g. ScannerAdfEmpty, ScannerAdfJam) for the poller
+        return ESCLScanner._fetch_status(scanner_ip)
+
+    @staticmethod
+    def invalidate_capabilities(scanner_ip=None):
+        with ESCLScanner._capabilities_cache_lock:
+            if scanner_ip is None:
+                ESCLScanner._capabilities_cache.clear()
+            else:
+                ESCLScanner._capabilities_cache.pop(scanner_ip, None)
+
+    @staticmethod
+    def cached_capabilities(scanner_ip):
+        # The capabilities if they are cached and not expired (without asking the scanner), None otherwise
+        with ESCLScanner._capabilities_cache_lock:
+            expires, caps = ESCLScanner._capabilities_cache.get(scanner_ip, (0, None))
+        if time.monotonic() < expires:
+            return caps
+        return None
+
+    @staticmethod
+    def get_capabilities(scanner_ip):
+        with metrics.timed('scanrest_phase_seconds', 'status'):
+            status, version, serial_number = ESCLScanner._get_status(scanner_ip)
+
+        caps = ESCLScanner.cached_capabilities(scanner_ip)
+        if caps is not None and (version is None or version == caps.version) and \
+                (serial_number is None or serial_number == caps.serial_number):
+            metrics.inc('scanrest_capabilities_cache_total', result='hit')
+            return status, caps
+
+        metrics.inc('scanrest_capabilities_cache_total', result='miss')
+        with metrics.timed('scanrest_phase_seconds', 'capabilities'):
+            caps = ESCLScanner._fetch_capabilities(scanner_ip)
+        if CAPABILITIES_TTL > 0:
+            with ESCLScanner._capabilities_cache_lock:
+                ESCLScanner._capabilities_cache[scanner_ip] = (time.monotonic() + CAPABILITIES_TTL, caps)
+        return status, caps
+
+    @staticmethod
+    def _fetch_capabilities(scanner_ip):
+        namespaces = ESCLScanner.namespaces
 
         # .content == .text in bytes
-        scanner_cap_xml = requests_get('http://{0}/eSCL/ScannerCapabilities'.format(scanner_ip)).content
+        scanner_cap_xml = ESCLScanner._get(scanner_ip, 'http://{0}/eSCL/ScannerCapabilities'.format(scanner_ip)).content
         scanner_cap_tree = ElementTree.fromstring(scanner_cap_xml)
         escl_version = scanner_cap_tree.find('./pwg:Version', namespaces).text
         make_and_model = scanner_cap_tree.find('./pwg:MakeAndModel', namespaces).text
         serial_number = scanner_cap_tree.find('./pwg:SerialNumber', namespaces).text
 
-        caps = {}
+        sources = {}
+        combinations = set()
         for source_name1, source_name2, source_name3 in \
                 (('Platen', 'Platen', 'Platen'), ('Adf', 'AdfSimplex', 'Feeder')):
             inp_caps = scanner_cap_tree.find('./scan:{0}/scan:{1}InputCaps'.format(source_name1, source_name2),
@@ -112,59 +290,81 @@ class ESCLScanner:
 
             width_range, height_range = ESCLScanner._get_range(inp_caps, namespaces)
 
-            formats = [ESCLScanner.mime_to_format[e.text]
-                       for e in inp_caps.findall('./scan:SettingProfiles/scan:SettingProfile/scan:DocumentFormats/'
-                                                 'pwg:DocumentFormat', namespaces)]
+            supported_intents = [e.text for e in inp_caps.findall('./scan:SupportedIntents/scan:Intent', namespaces)]
 
-            color_modes = sorted((ESCLScanner.color_modes_to_name[e.text]
-                                  for e in inp_caps.findall('./scan:SettingProfiles/scan:SettingProfile/'
-                                                            'scan:ColorModes/scan:ColorMode',
-                                                            namespaces)), reverse=True)
+            # The color modes and formats which can be used together are listed in the same setting profile
+            formats = []
+            color_modes = []
+            for profile in inp_caps.findall('./scan:SettingProfiles/scan:SettingProfile', namespaces):
+                profile_formats = [ESCLScanner.mime_to_format[e.text]
+                                   for e in profile.findall('./scan:DocumentFormats/pwg:DocumentFormat', namespaces)
+                                   if e.text in ESCLScanner.mime_to_format]
+                profile_color_modes = [ESCLScanner.color_modes_to_name[e.text]
+                                       for e in profile.findall('./scan:ColorModes/scan:ColorMode', namespaces)
+                                       if e.text in ESCLScanner.color_modes_to_name]
+                combinations.update(itertools.product((source_name3,), profile_color_modes, profile_formats,
+                                                      supported_intents))
+                formats.extend(profile_formats)
+                color_modes.extend(profile_color_modes)
 
             resolutions = ESCLScanner._get_resolutions(inp_caps, namespaces)
 
             # Comnpute pixel ranges for different DPIs (must be supplied in 300DPI to the scanner!)
-            width_ranges = {}
-            height_ranges = {}
-            for res in resolutions:
-                width_ranges[res] = range(width_range.start, (width_range.stop-1)*res//300+1)
-                height_ranges[res] = range(height_range.start, (height_range.stop-1)*res//300+1)
-
-            supported_intents = [e.text for e in inp_caps.findall('./scan:SupportedIntents/scan:Intent', namespaces)]
+            limits = {res: (width_range.start, (width_range.stop - 1) * res // 300,
+                            height_range.start, (height_range.stop - 1) * res // 300) for res in resolutions}
 
             max_optical_resolution = ESCLScanner._get_max_optical_resolution(inp_caps, namespaces)
 
-            caps[source_name3] = {'width': width_ranges, 'height': height_ranges, 'formats': formats,
-                                  'colormodes': color_modes, 'resolutions': resolutions, 'intents': supported_intents,
-                                  'max_optical_resolution': max_optical_resolution}
+            sources[source_name3] = SourceCapabilities(
+                name=source_name3, resolutions=tuple(resolutions), limits=MappingProxyType(limits),
+                colormodes=tuple(sorted(set(color_modes), reverse=True)), formats=tuple(dict.fromkeys(formats)),
+                intents=tuple(supported_intents), max_optical_resolution=max_optical_resolution)
+
+        # The form only needs the largest height and width for each resolution
+        caps_by_source = {name: {'width': {res: limit[1] for res, limit in source.limits.items()},
+                                 'height': {res: limit[3] for res, limit in source.limits.items()},
+                                 'formats': source.formats, 'colormodes': source.colormodes,
+                                 'resolutions': source.resolutions, 'intents': source.intents,
+                                 'max_optical_resolution': source.max_optical_resolution}
+                          for name, source in sources.items()}
+        json = dumps({'version': escl_version, 'makeandmodel': make_and_model, 'serialnumber': serial_number,
+                      'caps_by_source': caps_by_source})
 
-        return status, {'version': escl_version, 'makeandmodel': make_and_model, 'serialnumber': serial_number,
-                        'caps_by_source': caps}
+        return ScannerCapabilities(version=escl_version, make_and_model=make_and_model, serial_number=serial_number,
+                                   sources=MappingProxyType(sources), combinations=frozenset(combinations), json=json)
 
     @staticmethod
     def _put_together_query(caps, input_source, height, width, color_mode, resolution, image_format, intent):
-        version = caps['version']
-        if input_source not in caps['caps_by_source']:
+        version = caps.version
+        source = caps.sources.get(input_source)
+        if source is None:
             raise ValueError('Input source ({0}) is not in the available input sources ({1})!'.
-                             format(input_source, caps['caps_by_source']))
+                             format(input_source, ', '.join(caps.sources)))
 
-        caps_for_curr_source = caps['caps_by_source'][input_source]
+        limits = source.limits.get(resolution)
+        if limits is None:
+            raise ValueError('Resoluton ({0}) is not in resolutons ({1})!'.format(resolution, source.resolutions))
+        min_width, max_width, min_height, max_height = limits
 
         if height is None:
-            height = caps_for_curr_source['height'].get(resolution, 300).stop - 1
+            height = max_height
         if width is None:
-            width = caps_for_curr_source['width'].get(resolution, 300).stop - 1
-
-        checks = [(resolution, caps_for_curr_source['resolutions'], 'Resoluton', 'resolutons'),
-                  (height, caps_for_curr_source['height'][resolution], 'Height', 'range'),
-                  (width, caps_for_curr_source['width'][resolution], 'Width', 'range'),
-                  (color_mode, ESCLScanner.name_to_color_modes.keys(), 'Color mode', 'modes'),
-                  (image_format, ESCLScanner.format_to_mime.keys(), 'Format', 'formats'),
-                  (intent, caps_for_curr_source['intents'], 'Intent', 'intents'),
-                  ]
-        for value, good_values, name, name_of_values in checks:
-            if value not in good_values:
-                raise ValueError('{0} ({1}) is not in {2} ({3})!'.format(name, value, name_of_values, good_values))
+            width = max_width
+
+        for value, low, high, name in ((height, min_height, max_height, 'Height'),
+                                       (width, min_width, max_width, 'Width')):
+            if not low <= value <= high:
+                raise ValueError('{0} ({1}) is not in range ({2}-{3})!'.format(name, value, low, high))
+
+        if (input_source, color_mode, image_format, intent) not in caps.combinations:
+            for value, good_values, name, name_of_values in ((color_mode, source.colormodes, 'Color mode', 'modes'),
+                                                             (image_format, source.formats, 'Format', 'formats'),
+                                                             (intent, source.intents, 'Intent', 'intents')):
+                if value not in good_values:
+                    raise ValueError('{0} ({1}) is not in {2} ({3})!'.format(name, value, name_of_values,
+                                                                             good_values))
+            raise ValueError('Color mode ({0}) and format ({1}) can not be used together with {2}!'.
+                             format(color_mode, image_format, input_source))
 
         # Scale the height and width to 300DPI for the XML
         height = height*300//resolution
@@ -174,10 +374,23 @@ class ESCLScanner:
                                             ESCLScanner.name_to_color_modes[color_mode], resolution,
                                             ESCLScanner.format_to_mime[image_format], intent)
 
+    @staticmethod
+    def check_query(scanner_ip, input_source, height, width, color_mode, resolution, image_format, intent):
+        # The problem with the settings according to the cached capabilities (without asking the scanner) or None
+        caps = ESCLScanner.cached_capabilities(scanner_ip)
+        if caps is None:
+            return None
+        try:
+            ESCLScanner._put_together_query(caps, input_source, height, width, color_mode, resolution, image_format,
+                                            intent)
+        except ValueError as msg:
+            return str(msg)
+        return None
+
     @staticmethod
     def _post_xml(scanner_ip, xml):
-        resp = requests_post('http://{0}/eSCL/ScanJobs'.format(scanner_ip), data=xml,
-                             headers={'Content-Type': 'text/xml'})
+        resp = ESCLScanner.session(scanner_ip).post('http://{0}/eSCL/ScanJobs'.format(scanner_ip), data=xml,
+                                                    headers={'Content-Type': 'text/xml'}, timeout=HTTP_TIMEOUT)
         if resp.status_code == 201:
             return '{0}/NextDocument'.format(resp.headers['Location']), 201
         return resp.reason, resp.status_code
@@ -192,14 +405,314 @@ class ESCLScanner:
                                                   image_format, intent)
         except ValueError as msg:
             return msg, 400
-        return ESCLScanner._post_xml(scanner_ip, xml)
+        with metrics.timed('scanrest_phase_seconds', 'create_job'):
+            return ESCLScanner._post_xml(scanner_ip, xml)
+
+    @staticmethod
+    def next_document(scanner_ip, next_document_url, cancelled=None):
+        """
+        The scanner answers 503 (or nothing) while the scan head is still moving: the request is repeated with
+        exponential backoff and jitter until NEXT_DOCUMENT_DEADLINE. When the deadline passes or cancelled
+        (a threading.Event) is set the job is deleted on the scanner and ScanAborted is raised. The job is deleted
+        as well before other errors are raised
+        """
+        cancelled = cancelled or threading.Event()
+        deadline = time.monotonic() + NEXT_DOCUMENT_DEADLINE
+        delay = NEXT_DOCUMENT_BACKOFF[0]
+        # Read timeouts are not retried by the connection pool, only here with the backoff
+        session = ESCLScanner.session(scanner_ip, retry_reads=False)
+        while True:
+            remaining = deadline - time.monotonic()
+            start = time.perf_counter()
+            try:
+                response = session.get(next_document_url, stream=True,
+                                       timeout=(HTTP_TIMEOUT[0], max(0.1, min(HTTP_TIMEOUT[1], remaining))))
+                result = response.status_code
+            except Timeout:
+                response, result = None, 'timeout'
+            except RequestException:
+                ESCLScanner.cancel_job(scanner_ip, next_document_url)
+                raise
+            elapsed = time.perf_counter() - start
+            metrics.observe('scanrest_next_document_attempt_seconds', elapsed, result=result)
+            metrics.add_timing('next_document_attempts', elapsed)
+            if result not in {503, 'timeout'}:
+                return response
+
+            wait = random.uniform(delay / 2, delay)
+            if response is not None:
+                retry_after = response.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    wait = max(wait, int(retry_after))
+                response.close()
+            delay = min(delay * 2, NEXT_DOCUMENT_BACKOFF[1])
+            if time.monotonic() + wait > deadline:
+                ESCLScanner.cancel_job(scanner_ip, next_document_url)
+                raise ScanAborted(504, 'The scanner did not send the document in {0} seconds'.
+                                  format(NEXT_DOCUMENT_DEADLINE))
+            if cancelled.wait(wait):
+                ESCLScanner.cancel_job(scanner_ip, next_document_url)
+                raise ScanAborted(409, 'The scan was cancelled')
+
+    @staticmethod
+    def cancel_job(scanner_ip, next_document_url):
+        # Best effort, the scanner may have finished or dropped the job already
+        try:
+            ESCLScanner.session(scanner_ip).delete(next_document_url.rsplit('/', 1)[0], timeout=HTTP_TIMEOUT)
+        except RequestException:
+            pass
+
+
+class ScannerQueue:
+    """
+    FIFO admission to a scanner: one scan at a time, at most SCAN_QUEUE_LENGTH requests wait for their turn.
+    The request admitted in the process also takes the lock file of the scanner (flock), which serialises the scans
+    of the worker processes (without their order)
+    """
+    lock_poll_interval = 0.1  # Seconds between two attempts to take the lock file held by another process
+
+    def __init__(self, scanner_ip):
+        self._lock_path = os.path.join(SCAN_LOCK_FOLDER, 'scanner_{0}.lock'.format(re.sub('[^0-9A-Za-z.-]', '_',
+                                                                                          scanner_ip)))
+        self._lock_file = None
+        self._cond = threading.Condition()
+        self._tickets = itertools.count()
+        self._waiting = deque()
+        self._busy = False
+        self.scan_seconds = 30.0  # Moving average of the time a scan holds the scanner, used for Retry-After
+
+    def status(self):
+        with self._cond:
+            return {'busy': self._busy, 'waiting': len(self._waiting), 'scan_seconds': round(self.scan_seconds, 1)}
+
+    def retry_after(self, position):
+        return max(1, int(position * self.scan_seconds))
+
+    def acquire(self, timeout):
+        """
+        Returns (True, 0) when the scanner is ours or (False, queue position) when the request should come back later
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if self._busy or len(self._waiting) > 0:
+                if len(self._waiting) >= SCAN_QUEUE_LENGTH or timeout <= 0:
+                    return False, len(self._waiting) + 1
+
+                ticket = next(self._tickets)
+                self._waiting.append(ticket)
+                while self._busy or self._waiting[0] != ticket:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        position = self._waiting.index(ticket) + 1
+                        self._waiting.remove(ticket)
+                        self._cond.notify_all()
+                        return False, position
+                    self._cond.wait(remaining)
+                self._waiting.popleft()
+            self._busy = True
+        # The others of the process wait in the queue meanwhile
+        if not self._lock(deadline):
+            self.release()
+            return False, 1
+        return True, 0
+
+    def _lock(self, deadline):
+        # Polled, so a greenlet waiting for another process does not block the others
+        os.makedirs(SCAN_LOCK_FOLDER, exist_ok=True)
+        fh = open(self._lock_path, 'a')
+        while True:
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self._lock_file = fh
+                return True
+            except BlockingIOError:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    fh.close()
+                    return False
+                time.sleep(min(self.lock_poll_interval, remaining))
+
+    def release(self, held_seconds=None):
+        with self._cond:
+            if self._lock_file is not None:
+                self._lock_file.close()  # Releases the flock
+                self._lock_file = None
+            self._busy = False
+            if held_seconds is not None:
+                self.scan_seconds = 0.8 * self.scan_seconds + 0.2 * held_seconds
+            self._cond.notify_all()
+
+
+class ResultStore:
+    """
+    Finished scans on disk as RESULTS_FOLDER/<id>.<extension>, everything is in the file name and the
+    modification time, so any worker process can serve any result
+    """
+    extension_to_mime = {'pdf': 'application/pdf', 'jpeg': 'image/jpeg', 'zip': 'application/zip'}
+    id_re = re.compile('[0-9a-f]{32}$')
+
+    # lock to control access to the folder during eviction
+    _evict_lock = threading.Lock()
+
+    @staticmethod
+    def new_id():
+        return uuid.uuid4().hex
+
+    @staticmethod
+    def path(result_id, extension):
+        return os.path.join(RESULTS_FOLDER, '{0}.{1}'.format(result_id, extension))
+
+    @staticmethod
+    def find(result_id):
+        """
+        (path, extension) of a stored result or None if there is no such result (or it expired)
+        """
+        if ResultStore.id_re.match(result_id) is None:
+            return None
+        for extension in ResultStore.extension_to_mime.keys():
+            path = ResultStore.path(result_id, extension)
+            try:
+                if time.time() < os.path.getmtime(path) + RESULTS_MAX_AGE:
+                    return path, extension
+            except OSError:
+                continue
+        return None
 
+    @staticmethod
+    def evict(keep=None):
+        # Expired results (and parts of interrupted ones) go first, then the oldest while over RESULTS_MAX_BYTES
+        with ResultStore._evict_lock:
+            results = []
+            for entry in os.scandir(RESULTS_FOLDER):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if time.time() > stat.st_mtime + RESULTS_MAX_AGE:
+                    ResultStore._remove(entry.path)
+                elif not entry.name.endswith('.part') and entry.path != keep:
+                    results.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in results) + (os.path.getsize(keep) if keep is not None else 0)
+            for _, size, path in sorted(results):
+                if total <= RESULTS_MAX_BYTES:
+                    break
+                ResultStore._remove(path)
+                total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class StoredStream:
+    """
+    Passes the chunks of a scan on while writing them to the store. If the client goes away before the end,
+    the rest is read from the scanner in a background thread, so the result can still be downloaded.
+    on_done is called when the scanner is not needed anymore
+    """
+    def __init__(self, result_id, extension, chunks, cancelled, on_done):
+        self.result_id = result_id
+        self._path = ResultStore.path(result_id, extension)
+        self._chunks = iter(chunks)
+        self._cancelled = cancelled
+        self._on_done = on_done
+        os.makedirs(RESULTS_FOLDER, exist_ok=True)
+        self._fh = open('{0}.part'.format(self._path), 'wb')
+        self._finished = False
+        self._closed = False
 
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._finish(not self._cancelled.is_set())
+            raise
+        except Exception:
+            self._finish(False)
+            raise
+        self._fh.write(chunk)
+        return chunk
+
+    def close(self):
+        if not self._closed and not self._finished:
+            threading.Thread(target=self._drain, daemon=True).start()
+        self._closed = True
+
+    def _drain(self):
+        try:
+            for chunk in self._chunks:
+                self._fh.write(chunk)
+        except Exception:  # The scanner went away as well, there is nothing to keep
+            self._finish(False)
+        else:
+            self._finish(not self._cancelled.is_set())
+
+    def _finish(self, complete):
+        if self._finished:
+            return
+        self._finished = True
+        self._fh.close()
+        if complete:
+            os.replace('{0}.part'.format(self._path), self._path)
+            ResultStore.evict(keep=self._path)
+        else:
+            ResultStore._remove('{0}.part'.format(self._path))
+        for callback in self._on_done:
+            callback()
+
+
+# name -> {'name': ..., 'ip': ..., 'queue': ScannerQueue, 'poller': StatePoller, 'cancel': threading.Event}
+scanners = {}
 # lock to control access to variable
 scan_lock = threading.Lock()
 
-app = Flask(__name__)
-api = Api(app)
+
+def get_scanners():
+    with scan_lock:
+        if len(scanners) == 0:
+            for name, scanner_ip in (SCANNERS or {SCANNER_IP: SCANNER_IP}).items():
+                poller = StatePoller(name, partial(ESCLScanner.get_state, scanner_ip), POLL_INTERVALS,
+                                     busy=lambda state: state is not None and state['state'] != 'Idle')
+                scanners[name] = {'name': name, 'ip': scanner_ip, 'queue': ScannerQueue(scanner_ip), 'poller': poller,
+                                  'cancel': threading.Event()}
+                if SCANNER_POLLING:
+                    poller.start()
+        return scanners
+
+
+def get_scanner(name=''):
+    # The first scanner is the default one
+    registry = get_scanners()
+    if name == '':
+        return next(iter(registry.values()))
+    return registry.get(name)
+
+
+def admit(scanner, phase_metric):
+    """
+    Wait for the turn of the request in the queue of the scanner (timed as queue_wait in phase_metric).
+    Returns None when the scanner is ours (release it with scanner['queue'].release()) or the 429 response
+    with the queue position and Retry-After when the request should come back later
+    """
+    with metrics.timed(phase_metric, 'queue_wait'):
+        admitted, position = scanner['queue'].acquire(SCAN_QUEUE_TIMEOUT)
+    if admitted:
+        return None
+    retry_after = scanner['queue'].retry_after(position)
+    return jsonify(error='The scanner is busy', scanner=scanner['name'], queue_position=position,
+                   retry_after=retry_after), 429, {'Retry-After': str(retry_after)}
+
+
+blueprint = Blueprint('scanrest', __name__)
+metrics.account_requests(blueprint, 'scanrest')
+# 'scan/<scanner name>' -> the form rendered from the capabilities of the scanner
+pages = PageCache()
 
 scan_settings_form = """
 <!DOCTYPE html>
@@ -304,6 +817,12 @@ function onload() {
 <body onload="onload()">
 
 <form action="" method="post">
+    <p>
+        Scanner: <br/>
+        <select name="scanner" onchange="location.search = '?scanner=' + encodeURIComponent(this.value)">
+SCANNER_OPTIONS_PLACEHOLDER
+        </select>
+    </p>
     <p>
         Input Source: <br/>
         <select id="inputSource" name="inputSource" onchange="refresh()">
@@ -322,6 +841,13 @@ function onload() {
     </p>
     <p id="intents">
     </p>
+    <p>
+        Post-processing (JPEG only): <br/>
+POSTPROCESS_OPTIONS_PLACEHOLDER
+    </p>
+    <p>
+        <label><input type="checkbox" name="multipage" value="on"> All pages from the feeder (ZIP archive)</label>
+    </p>
     <p>
         <input type="submit" value="Scan" name="submit">
     </p>
@@ -332,26 +858,111 @@ function onload() {
 """
 
 
+class StreamBuffer:
+    """
+    Write-only file object for ZipFile, which collects the bytes written since the last drain()
+    """
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
 class ScanREST(Resource):
     @staticmethod
-    @app.route('/scan')
+    @blueprint.route('/scan')
     def usage():
-        status, scanner_caps = ESCLScanner.get_capabilities(SCANNER_IP)
+        scanner = get_scanner(request.args.get('scanner', ''))
+        if scanner is None:
+            return 'No such scanner: {0}'.format(request.args['scanner']), 404
+        try:
+            status, scanner_caps = ESCLScanner.get_capabilities(scanner['ip'])
+        except RequestException as e:
+            return 'Scanner is not reachable: {0}'.format(e), 503
         if status != 'Idle':
             return 'Status is not "Idle" ({0})!'.format(status), 500
 
-        # Replace ranges with maximum values
-        for source in scanner_caps['caps_by_source'].keys():
-            for res in scanner_caps['caps_by_source'][source]['height'].keys():
-                scanner_caps['caps_by_source'][source]['height'][res] = \
-                    scanner_caps['caps_by_source'][source]['height'][res].stop - 1
-                scanner_caps['caps_by_source'][source]['width'][res] = \
-                    scanner_caps['caps_by_source'][source]['width'][res].stop - 1
-        json = dumps(scanner_caps)
-        return scan_settings_form.replace('JSON_PLACEHOLDER', json)
+        # Rendered again only when the capabilities are fetched again
+        return page_response(pages.get('scan/{0}'.format(scanner['name']), scanner_caps,
+                                       lambda: ScanREST._render_form(scanner, scanner_caps)))
+
+    @staticmethod
+    def _render_form(scanner, scanner_caps):
+        options = '\n'.join('<option value="{0}"{1}>{0}</option>'.format(name, ' selected' * (name == scanner['name']))
+                            for name in get_scanners().keys())
+        profiles = '\n'.join('<label><input type="radio" name="postprocess" value="{0}"{1}> {0}</label>'.
+                             format(name, ' checked' * (name == 'none')) for name in postprocess.profile_names())
+        return scan_settings_form.replace('JSON_PLACEHOLDER', scanner_caps.json).\
+            replace('SCANNER_OPTIONS_PLACEHOLDER', options).replace('POSTPROCESS_OPTIONS_PLACEHOLDER', profiles)
+
+    @staticmethod
+    @blueprint.route('/scan/refresh', methods=['POST'])
+    def refresh():
+        scanner = get_scanner(request.values.get('scanner', ''))
+        if scanner is None:
+            return 'No such scanner: {0}'.format(request.values['scanner']), 404
+        ESCLScanner.invalidate_capabilities(scanner['ip'])
+        return 'Scanner capabilities will be fetched again on the next request.'
+
+    @staticmethod
+    @blueprint.route('/scan/queue')
+    def queue():
+        return jsonify({name: scanner['queue'].status() for name, scanner in get_scanners().items()})
+
+    @staticmethod
+    @blueprint.route('/scan/results/<result_id>')
+    def result(result_id):
+        """
+        A scanned document again, without the scanner: supports Range requests to resume interrupted
+        downloads and If-None-Match to skip unchanged ones
+        """
+        found = ResultStore.find(result_id)
+        if found is None:
+            return 'No such scan result (or it has expired): {0}'.format(result_id), 404
+        path, extension = found
+        resp = send_file(path, mimetype=ResultStore.extension_to_mime[extension], as_attachment=True,
+                         attachment_filename='scan_{0}.{1}'.format(result_id, extension), conditional=True,
+                         cache_timeout=RESULTS_MAX_AGE)
+        resp.cache_control.public = False
+        resp.cache_control.private = True  # Whoever knows the id can download the document, proxies should not
+        return resp
+
+    @staticmethod
+    @blueprint.route('/scan/cancel', methods=['POST'])
+    def cancel():
+        # The running scan stops at the next chunk or retry and its job is deleted on the scanner
+        scanner = get_scanner(request.values.get('scanner', ''))
+        if scanner is None:
+            return 'No such scanner: {0}'.format(request.values['scanner']), 404
+        if not scanner['queue'].status()['busy']:
+            return 'No scan is running on {0}.'.format(scanner['name']), 409
+        scanner['cancel'].set()
+        return 'The scan on {0} is being cancelled.'.format(scanner['name'])
+
+    @staticmethod
+    @blueprint.route('/scan/state')
+    def state():
+        # Served from the background pollers, ?since=<version>&wait=<seconds> waits for the next change
+        return state_response([scanner['poller'] for scanner in get_scanners().values()])
+
+    @staticmethod
+    @blueprint.route('/scan/events')
+    def events():
+        # Server-sent events with the state of the scanners (Idle, Processing, ADF empty or jammed...)
+        return events_response([scanner['poller'] for scanner in get_scanners().values()])
 
     @staticmethod
-    @app.route('/scan', methods=['POST'])
+    @blueprint.route('/scan', methods=['POST'])
     def scan():
         input_source = request.form['inputSource']
         height = request.form['height']
@@ -375,19 +986,236 @@ class ScanREST(Resource):
             return 'Values of {0} must be Integer instead of {1}!'.format('Height, Width and Resolution',
                                                                           ', '.join((height, width, resolution))), 400
 
-        msg, status = ESCLScanner.scan(SCANNER_IP, input_source, height, width, color_mode, resolution, image_format,
-                                       intent)
-        if status == 201:
-            response = requests_get(msg, stream=True)
-            headers = dict(response.headers)
-            mime = headers['Content-Type']
-            name = '{0}.{1}'.format(headers['Content-Location'].split('/')[-1],
+        multipage = request.form.get('multipage') == 'on'
+        profile_name = request.form.get('postprocess') or 'none'
+        if profile_name not in postprocess.profile_names():
+            return 'No such post-processing: {0}'.format(profile_name), 400
+        profile = postprocess.PROFILES[profile_name] if image_format == 'JPEG' else None
+
+        scanner = get_scanner(request.values.get('scanner', ''))
+        if scanner is None:
+            return 'No such scanner: {0}'.format(request.values['scanner']), 404
+
+        # Wrong settings are refused without waiting for the scanner, if its capabilities are known
+        problem = ESCLScanner.check_query(scanner['ip'], input_source, height, width, color_mode, resolution,
+                                          image_format, intent)
+        if problem is not None:
+            return 'Some parameters are wrong: {0}'.format(problem), 400
+
+        # The scanner is held until the last byte of the document is passed on (or the client goes away)
+        busy = admit(scanner, 'scanrest_phase_seconds')
+        if busy is not None:
+            return busy
+        started = time.monotonic()
+        scanner['cancel'].clear()
+        try:
+            ret = ScanREST._scan(scanner['ip'], input_source, height, width, color_mode, resolution, image_format,
+                                 intent, multipage, scanner['cancel'], profile)
+        except Exception:
+            scanner['queue'].release()
+            raise
+        scanner['poller'].poke()  # The job is running (or failed) on the scanner
+        if not isinstance(ret, Response):
+            scanner['queue'].release()
+            return ret
+
+        release = [lambda: scanner['queue'].release(time.monotonic() - started), scanner['poller'].poke]
+        if RESULTS_MAX_AGE <= 0:
+            # The request context is kept for the streamed body to collect the download time for the timing log
+            ret.response = ClosingIterator(stream_with_context(ret.response), release)
+            return ret
+
+        extension = 'zip' if ret.mimetype == 'application/zip' else ESCLScanner.mime_to_format[ret.mimetype].lower()
+        try:
+            stored = StoredStream(ResultStore.new_id(), extension, ret.response, scanner['cancel'], release)
+        except OSError:
+            ret.response.close()
+            scanner['queue'].release()
+            raise
+        result_url = url_for('.result', result_id=stored.result_id)
+        if request.accept_mimetypes.best == 'application/json':
+            # Scan to the store only, the document is downloaded from result_url
+            try:
+                with metrics.timed('scanrest_phase_seconds', 'store'):
+                    for _ in stored:
+                        pass
+            except RequestException as e:
+                return jsonify(error='Scanner is not reachable: {0}'.format(e), scanner=scanner['name']), 503
+            except ScanAborted as e:
+                return jsonify(error=e.message, scanner=scanner['name']), e.status_code
+            if ResultStore.find(stored.result_id) is None:
+                return jsonify(error='The scan was not completed', scanner=scanner['name']), 502
+            return jsonify(id=stored.result_id, url=result_url, mimetype=ret.mimetype), 201, {'Location': result_url}
+        ret.response = ClosingIterator(stream_with_context(stored), stored.close)
+        ret.headers['Content-Location'] = result_url
+        ret.headers['X-Scan-Result-Id'] = stored.result_id
+        return ret
+
+    @staticmethod
+    def _scan(scanner_ip, input_source, height, width, color_mode, resolution, image_format, intent, multipage,
+              cancelled, profile=None):
+        # profile: the post-processing settings for the JPEG pages (None to pass them through unchanged)
+        try:
+            msg, status = ESCLScanner.scan(scanner_ip, input_source, height, width, color_mode, resolution,
+                                           image_format, intent)
+            if status == 201:
+                with metrics.timed('scanrest_phase_seconds', 'first_byte'):
+                    response = ESCLScanner.next_document(scanner_ip, msg, cancelled)
+                if cancelled.is_set():  # Cancelled before the first byte could be passed on
+                    response.close()
+                    ESCLScanner.cancel_job(scanner_ip, msg)
+                    raise ScanAborted(409, 'The scan was cancelled')
+        except RequestException as e:
+            return 'Scanner is not reachable: {0}'.format(e), 503
+        except ScanAborted as e:
+            metrics.inc('scanrest_scans_total', status=e.status_code)
+            return e.message, e.status_code
+        metrics.inc('scanrest_scans_total', status=status)
+        if status == 201 and response.status_code != 200:
+            response.close()
+            ESCLScanner.cancel_job(scanner_ip, msg)
+            return 'The scanner did not return any document: {0}'.format(response.reason), 502
+        elif status == 201 and multipage:
+            name = 'scan_{0}.zip'.format(msg.split('/')[-2])
+            return Response(ScanREST._stream_pages(scanner_ip, msg, response, image_format.lower(), cancelled,
+                                                   resolution, profile), mimetype='application/zip',
+                            headers={'Content-Disposition': 'attachment; filename="{0}"'.format(name)})
+        elif status == 201:
+            mime = response.headers['Content-Type']
+            name = '{0}.{1}'.format(response.headers['Content-Location'].split('/')[-1],
                                     ESCLScanner.mime_to_format[mime].lower())
-            return send_file(BytesIO(response.content), mimetype=headers['Content-Type'], attachment_filename=name,
-                             as_attachment=True)
+            headers = {'Content-Disposition': 'attachment; filename="{0}"'.format(name)}
+            # The body is passed through undecoded only when the scanner did not compress it
+            if 'Content-Length' in response.headers and 'Content-Encoding' not in response.headers and \
+                    profile is None:
+                headers['Content-Length'] = response.headers['Content-Length']
+            return Response(ScanREST._stream_document(scanner_ip, msg, response, cancelled, resolution, profile),
+                            mimetype=mime, headers=headers)
         else:
             return 'Some parameters are wrong: {0}'.format(msg), status
 
+    @staticmethod
+    def _stream_document(scanner_ip, next_document_url, response, cancelled, resolution=None, profile=None):
+        """
+        Forward the chunks as they arrive from the scanner, the connection is closed and the job is deleted
+        if the client goes away or the scan is cancelled. A cancelled scan raises ScanAborted, so the server
+        drops the connection instead of ending the response as if the document was complete.
+        With a post-processing profile the whole document is collected and processed first
+        """
+        completed = False
+        chunks = []
+        try:
+            with metrics.timed('scanrest_phase_seconds', 'download'):
+                for chunk in response.iter_content(SCAN_CHUNK_SIZE):
+                    if cancelled.is_set():
+                        raise ScanAborted(409, 'The scan was cancelled')
+                    if profile is None:
+                        yield chunk
+                    else:
+                        chunks.append(chunk)
+            completed = True
+        finally:
+            response.close()
+            if not completed:
+                ESCLScanner.cancel_job(scanner_ip, next_document_url)
+        if profile is not None:
+            data = b''.join(chunks)
+            yield ScanREST._postprocessed(data, postprocess.submit(data, resolution, profile))
+
+    @staticmethod
+    def _postprocessed(data, future):
+        # The result of the post-processing, the scanned page as it is if the post-processing failed
+        try:
+            with metrics.timed('scanrest_phase_seconds', 'postprocess'):
+                processed = future.result()
+        except Exception:  # Any failure in the worker process (or the pool itself)
+            metrics.inc('scanrest_postprocess_failures_total')
+            return data
+        metrics.inc('scanrest_postprocess_bytes_total', len(data), stage='scanned')
+        metrics.inc('scanrest_postprocess_bytes_total', len(processed), stage='processed')
+        return processed
+
+    @staticmethod
+    def _stream_pages(scanner_ip, next_document_url, response, extension, cancelled, resolution=None, profile=None):
+        """
+        Pull NextDocument until the scanner has no more pages (404) and stream each page into a ZIP archive
+        as it arrives, only the current chunk and the ZIP central directory is held in memory.
+        With a post-processing profile the pages are processed in the background while the next page is
+        scanned, and written to the archive in order as they are done.
+        The archive is left unfinished (ScanAborted or the error of the scanner is raised, so the server drops
+        the connection) if the scan is cancelled or the scanner stops sending pages with any other answer than 404
+        """
+        out = StreamBuffer()
+        completed = False
+        processing = deque()  # (ZipInfo, scanned page, future of the processed page)
+        try:
+            with metrics.timed('scanrest_phase_seconds', 'download'), ZipFile(out, 'w', ZIP_STORED) as archive:
+                page = 1
+                while response.status_code == 200:
+                    page_info = ZipInfo('page_{0:03d}.{1}'.format(page, extension), time.localtime()[:6])
+                    if profile is None:
+                        with archive.open(page_info, 'w') as fh:
+                            for chunk in response.iter_content(SCAN_CHUNK_SIZE):
+                                if cancelled.is_set():
+                                    raise ScanAborted(409, 'The scan was cancelled')
+                                fh.write(chunk)
+                                yield out.drain()
+                    else:
+                        chunks = []
+                        for chunk in response.iter_content(SCAN_CHUNK_SIZE):
+                            if cancelled.is_set():
+                                raise ScanAborted(409, 'The scan was cancelled')
+                            chunks.append(chunk)
+                        data = b''.join(chunks)
+                        processing.append((page_info, data, postprocess.submit(data, resolution, profile)))
+                        while len(processing) > 0 and processing[0][2].done():
+                            page_info, data, future = processing.popleft()
+                            archive.writestr(page_info, ScanREST._postprocessed(data, future))
+                            yield out.drain()
+                    response.close()
+                    page += 1
+                    try:
+                        response = ESCLScanner.next_document(scanner_ip, next_document_url, cancelled)
+                    except (ScanAborted, RequestException):
+                        cancelled.set()  # Tells that the archive is incomplete
+                        raise
+                    if response.status_code not in {200, 404}:  # A jam or a failure, not the end of the feed
+                        cancelled.set()
+                        raise ScanAborted(502, 'The scanner stopped sending pages after page {0}: {1} {2}'.
+                                          format(page - 1, response.status_code, response.reason))
+                completed = True
+                for page_info, data, future in processing:
+                    archive.writestr(page_info, ScanREST._postprocessed(data, future))
+                    yield out.drain()
+            yield out.drain()
+        finally:
+            response.close()
+            if not completed:
+                ESCLScanner.cancel_job(scanner_ip, next_document_url)
+
+
+def init_app(app):
+    app.register_blueprint(blueprint)
+
+
+def warm_up():
+    """
+    Fetch the capabilities of every scanner (which opens its pooled connection) and render its form, so the first
+    requests after the start do not wait for them. Returns scanner name -> error (None if it answered)
+    """
+    errors = {}
+    for name, scanner in get_scanners().items():
+        try:
+            _, caps = ESCLScanner.get_capabilities(scanner['ip'])
+            pages.get('scan/{0}'.format(name), caps, partial(ScanREST._render_form, scanner, caps))
+            errors[name] = None
+        except Exception as e:  # An unreachable scanner must not stop the others
+            errors[name] = str(e)
+    return errors
+
+
+__getattr__ = application.lazy_app(__name__)  # from scanrest import app
+
 
 if __name__ == '__main__':
-    app.run(debug=False)
+    application.service_app('scanrest').run(debug=False)
@@ -0,0 +1,42 @@
+#!/usr/bin/python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Cooperative serving mode: every request runs as a greenlet on one event loop, so a single process holds many
+scans and print jobs in flight while they wait for the devices (eSCL and IPP over HTTP, lp and ipptool):
+
+    python3 serve.py --bind 0.0.0.0:8000 scanrest printrest copyrest
+
+The services are mounted on one app (see application.py) with their routes and forms unchanged, so they share
+the scanner queues and printer locks, which still let one job at a time to a device.
+"""
+
+from gevent import monkey
+monkey.patch_all()  # Before the apps import socket, ssl, threading, time or subprocess
+
+import argparse
+
+from gevent.pywsgi import WSGIServer
+
+from application import SERVICES, create_app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('services', nargs='*', default=list(SERVICES),
+                        help='Services to serve (default: {0})'.format(' '.join(SERVICES)))
+    parser.add_argument('--config', help='Config file (default: $DRIVERLESS_CONFIG)')
+    parser.add_argument('--warm-up', action='store_true', default=None,
+                        help='Query the devices and render the forms at the start')
+    parser.add_argument('--bind', default='127.0.0.1:8000', help='Address and port to listen on')
+    parser.add_argument('--connections', type=int, default=1000, help='Requests served at the same time')
+    args = parser.parse_args()
+
+    host, port = args.bind.rsplit(':', 1)
+    app = create_app(args.services, args.config, args.warm_up)
+    server = WSGIServer((host, int(port)), app, spawn=args.connections)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+IPPPrinter against a local stand-in printer (benchmark.FakePrinter):
+
+    python3 -m unittest test_ipp
+"""
+
+import io
+import unittest
+
+from requests import HTTPError
+
+from ipp import IPPPrinter, IPPError, CHUNK_SIZE
+from benchmark import FakePrinter, start_device
+
+
+class RecordingPrinter(FakePrinter):
+    """
+    Keeps the requests it receives, answers with status_code (and status-message) when it is not successful-ok,
+    with http_status when it is not 200 or with the raw reply_body when it is set
+    """
+    received = []
+    status_code = 0x0000
+    http_status = 200
+    reply_body = None
+
+    def _read_body(self):
+        body = super()._read_body()
+        self.received.append(body)
+        return body
+
+    def do_POST(self):
+        if self.reply_body is not None:
+            self._read_body()
+            return self._reply(200, self.reply_body, 'application/ipp')
+        if self.status_code == 0x0000 and self.http_status == 200:
+            return super().do_POST()
+        _, _, request_id, _, _ = IPPPrinter.decode(self._read_body())
+        if self.http_status != 200:
+            return self._reply(self.http_status)
+        attributes = [('operation', [('charset', 'attributes-charset', 'utf-8'),
+                                     ('naturalLanguage', 'attributes-natural-language', 'en'),
+                                     ('textWithoutLanguage', 'status-message', 'printer is busy')])]
+        self._reply(200, IPPPrinter.encode(self.status_code, request_id, attributes), 'application/ipp')
+
+
+class IPPPrinterTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.printer_uri = 'ipp://{0}/ipp/print'.format(start_device(RecordingPrinter, 0.0))
+
+    def setUp(self):
+        RecordingPrinter.received.clear()
+        RecordingPrinter.status_code = 0x0000
+        RecordingPrinter.http_status = 200
+        RecordingPrinter.reply_body = None
+
+    def last_request(self):
+        # (operation name, {group name: {attribute name: [values]}}, document)
+        _, code, _, groups, offset = IPPPrinter.decode(RecordingPrinter.received[-1])
+        operations = {code: name for name, code in IPPPrinter.operations.items()}
+        group_names = {tag: name for name, tag in IPPPrinter.group_tags.items()}
+        return (operations[code], {group_names[tag]: attributes for tag, attributes in groups},
+                RecordingPrinter.received[-1][offset:])
+
+    def test_http_url(self):
+        self.assertEqual(IPPPrinter.http_url('ipp://printer/ipp/print'), 'http://printer:631/ipp/print')
+        self.assertEqual(IPPPrinter.http_url('ipps://printer:443/ipp/print'), 'https://printer:443/ipp/print')
+        self.assertEqual(IPPPrinter.http_url('http://printer:8631/ipp'), 'http://printer:8631/ipp')
+
+    def test_encode_decode(self):
+        groups = [('operation', [('charset', 'attributes-charset', 'utf-8'),
+                                 ('keyword', 'requested-attributes', ['printer-state', 'queued-job-count'])]),
+                  ('job', [('integer', 'copies', 2), ('boolean', 'last-document', False),
+                           ('rangeOfInteger', 'page-ranges', [(1, 5), (8, 8)]),
+                           ('resolution', 'printer-resolution', (600, 600, 3)), ('no-value', 'job-name', None)])]
+        version, code, request_id, decoded, offset = IPPPrinter.decode(IPPPrinter.encode(0x0005, 7, groups) + b'%PDF')
+        self.assertEqual((version, code, request_id), ((1, 1), 0x0005, 7))
+        self.assertEqual(decoded, [(0x01, {'attributes-charset': ['utf-8'],
+                                           'requested-attributes': ['printer-state', 'queued-job-count']}),
+                                   (0x02, {'copies': [2], 'last-document': [False], 'page-ranges': [(1, 5), (8, 8)],
+                                           'printer-resolution': [(600, 600, 3)], 'job-name': [None]})])
+        self.assertEqual(offset, len(IPPPrinter.encode(0x0005, 7, groups)))
+
+    def test_create_job(self):
+        job_attributes = [('integer', 'copies', 2), ('keyword', 'sides', 'two-sided-long-edge'),
+                          ('enum', 'orientation-requested', 3),
+                          ('rangeOfInteger', 'page-ranges', IPPPrinter.page_ranges('1-5,8'))]
+        resp = IPPPrinter.create_job(self.printer_uri, job_attributes, job_name='report.pdf', user='alice')
+        resp.raise_for_status()
+        self.assertTrue(resp.ok)
+        self.assertEqual(resp.status, 'successful-ok')
+        self.assertIsInstance(resp.job_id, int)
+        self.assertEqual(resp.get('job', 'job-state'), 3)
+
+        operation, groups, document = self.last_request()
+        self.assertEqual(operation, 'Create-Job')
+        self.assertEqual(groups['operation'], {'attributes-charset': ['utf-8'],
+                                               'attributes-natural-language': ['en'],
+                                               'printer-uri': [self.printer_uri],
+                                               'requesting-user-name': ['alice'], 'job-name': ['report.pdf']})
+        self.assertEqual(groups['job'], {'copies': [2], 'sides': ['two-sided-long-edge'],
+                                         'orientation-requested': [3], 'page-ranges': [(1, 5), (8, 8)]})
+        self.assertEqual(document, b'')
+
+    def test_send_document(self):
+        resp = IPPPrinter.send_document(self.printer_uri, 12, b'%PDF-1.4 part', last_document=False,
+                                        document_name='report.pdf (1/3)', user='alice')
+        resp.raise_for_status()
+        operation, groups, document = self.last_request()
+        self.assertEqual(operation, 'Send-Document')
+        self.assertEqual(groups['operation']['job-id'], [12])
+        self.assertEqual(groups['operation']['last-document'], [False])
+        self.assertEqual(groups['operation']['document-format'], ['application/pdf'])
+        self.assertEqual(groups['operation']['document-name'], ['report.pdf (1/3)'])
+        self.assertEqual(document, b'%PDF-1.4 part')
+
+    def test_send_document_file(self):
+        # A file object is streamed after the message in chunks of CHUNK_SIZE
+        data = bytes(range(256)) * (CHUNK_SIZE // 256 * 2 + 1)
+        IPPPrinter.send_document(self.printer_uri, 13, io.BytesIO(data)).raise_for_status()
+        _, groups, document = self.last_request()
+        self.assertEqual(groups['operation']['last-document'], [True])
+        self.assertNotIn('document-name', groups['operation'])
+        self.assertEqual(document, data)
+
+    def test_get_printer_attributes(self):
+        resp = IPPPrinter.get_printer_attributes(self.printer_uri, ['printer-state', 'printer-state-reasons'],
+                                                 timeout=5)
+        self.assertEqual(IPPPrinter.printer_states[resp.get('printer', 'printer-state')], 'idle')
+        self.assertEqual(resp.get('printer', 'printer-state-reasons'), 'none')
+        self.assertEqual(resp.get('printer', 'queued-job-count'), 0)
+        self.assertEqual(resp.get('printer', 'printer-name', 'default'), 'default')
+        self.assertEqual(resp.group('unsupported'), {})
+
+        operation, groups, _ = self.last_request()
+        self.assertEqual(operation, 'Get-Printer-Attributes')
+        self.assertEqual(groups['operation']['requested-attributes'], ['printer-state', 'printer-state-reasons'])
+
+    def test_error_status(self):
+        RecordingPrinter.status_code = 0x0507
+        resp = IPPPrinter.create_job(self.printer_uri, [('integer', 'copies', 1)])
+        self.assertFalse(resp.ok)
+        self.assertIsNone(resp.job_id)
+        self.assertEqual(resp.status, 'server-error-busy')
+        self.assertEqual(resp.status_message, 'printer is busy')
+        with self.assertRaises(IPPError) as context:
+            resp.raise_for_status()
+        self.assertEqual(context.exception.status_code, 0x0507)
+        self.assertEqual(str(context.exception), 'server-error-busy (0x0507): printer is busy')
+
+    def test_unknown_error_status(self):
+        RecordingPrinter.status_code = 0x04ff
+        resp = IPPPrinter.send_document(self.printer_uri, 12, b'%PDF-1.4')
+        self.assertEqual(resp.status, '0x04ff')
+        with self.assertRaises(IPPError) as context:
+            resp.raise_for_status()
+        self.assertEqual(str(context.exception), 'unknown (0x04ff): printer is busy')
+
+    def test_http_error(self):
+        RecordingPrinter.http_status = 500
+        with self.assertRaises(HTTPError):
+            IPPPrinter.cancel_job(self.printer_uri, 12)
+        operation, groups, _ = self.last_request()
+        self.assertEqual((operation, groups['operation']['job-id']), ('Cancel-Job', [12]))
+
+    def test_malformed_reply(self):
+        # Not IPP at all, cut in the header, and cut in the middle of an attribute
+        message = IPPPrinter.encode(0x0000, 1, [('operation', [('charset', 'attributes-charset', 'utf-8')])])
+        for body in (b'<html><body>Not Found</body></html>', b'<html>', message[:-5]):
+            RecordingPrinter.reply_body = body
+            with self.assertRaises(IPPError) as context:
+                IPPPrinter.send_document(self.printer_uri, 12, b'%PDF-1.4')
+            self.assertEqual(context.exception.status_code, 0x0400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Post-processing profiles on scans served by serve.py (gevent) from a local stand-in scanner (benchmark.FakeScanner):
+
+    python3 -m unittest test_postprocess
+"""
+
+import os
+import sys
+import time
+import socket
+import unittest
+import subprocess
+from io import BytesIO
+from zipfile import ZipFile
+from importlib.util import find_spec
+
+import requests
+
+from benchmark import FakeScanner, start_device
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCAN_TIMEOUT = 30  # Seconds, a deadlocked pool never answers
+
+
+def scanned_page():
+    # A 300 dpi grayscale page of slanted lines, which all the profiles make smaller
+    from PIL import Image, ImageDraw
+    image = Image.new('L', (2000, 2800), 255)
+    draw = ImageDraw.Draw(image)
+    for y in range(300, 2500, 40):
+        draw.line((200, y, 1800, y + 60), fill=0, width=6)
+    out = BytesIO()
+    image.save(out, 'JPEG', quality=95, dpi=(300, 300))
+    return out.getvalue()
+
+
+@unittest.skipUnless(all(find_spec(name) is not None for name in ('gevent', 'numpy', 'PIL')),
+                     'needs gevent, NumPy and Pillow')
+class ServedPostprocessTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FakeScanner.document = scanned_page()
+        scanner = start_device(FakeScanner, 0.0)
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        env = dict(os.environ, SCANREST_SCANNER_IP=scanner, SCANREST_RESULTS_MAX_AGE='0',
+                   SCANREST_SCANNER_POLLING='false')
+        cls.server = subprocess.Popen([sys.executable, os.path.join(HERE, 'serve.py'), '--bind',
+                                       '127.0.0.1:{0}'.format(port), 'scanrest'], env=env, cwd=HERE,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        cls.url = 'http://127.0.0.1:{0}/scan'.format(port)
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                requests.get(cls.url, timeout=5)
+                break
+            except requests.ConnectionError:
+                if time.monotonic() > deadline or cls.server.poll() is not None:
+                    cls.tearDownClass()
+                    raise
+                time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.kill()
+        cls.server.wait()
+        FakeScanner.document = None
+
+    def scan(self, **fields):
+        form = {'inputSource': 'Platen', 'height': '', 'width': '', 'colormodes': 'Grayscale', 'resolutions': '300',
+                'formats': 'JPEG', 'intents': 'Document', 'postprocess': 'email'}
+        form.update(fields)
+        resp = requests.post(self.url, data=form, timeout=SCAN_TIMEOUT)
+        self.assertEqual(resp.status_code, 200, resp.text)
+        return resp
+
+    def assert_processed(self, data):
+        from PIL import Image
+        self.assertLess(len(data), len(FakeScanner.document))
+        image = Image.open(BytesIO(data))
+        self.assertEqual(image.format, 'JPEG')
+        self.assertEqual(round(image.info['dpi'][0]), 150)
+
+    def test_platen(self):
+        self.assert_processed(self.scan().content)
+
+    def test_feeder(self):
+        # Every page of the feeder is processed while the next one is scanned, and the scanner is released after
+        for _ in range(2):
+            resp = self.scan(inputSource='Feeder', multipage='on')
+            with ZipFile(BytesIO(resp.content)) as archive:
+                names = archive.namelist()
+                self.assertEqual(len(names), FakeScanner.feeder_pages)
+                for name in names:
+                    self.assert_processed(archive.read(name))
+
+
+if __name__ == '__main__':
+    unittest.main()